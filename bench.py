@@ -0,0 +1,525 @@
+"""Benchmarks locales del bot (sin red).
+
+Uso:
+    python bench.py storage [--sizes 1000,100000,1000000] [--backend sqlite|json]
+    python bench.py handlers [--menu 50] [--rounds 5000] [--photos] [--gallery]
+    python bench.py load [--users 100] [--workers 1,4,16,64] [--latency 0.02] [--sizes 1000,100000,1000000] [--backend json|sqlite] [--repeat 0.3] [--gallery]
+    python bench.py startup [--size 10000] [--runs 5] [--budget MS] [--backend json|sqlite]
+    python bench.py restart [--backend json|sqlite]
+"""
+import argparse
+import asyncio
+import collections
+import functools
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+from telegram import Update
+from telegram.ext import Application, CallbackContext
+from telegram.request import BaseRequest
+from telegram.warnings import PTBUserWarning
+
+import bot
+
+STATUSES = ["PENDIENTE", "ACEPTADO", "REALIZADO", "RECHAZADO"]
+
+ACTIVE_ORDERS = 500
+
+def fake_order(i, users, size):
+    # El historial está terminado salvo los últimos ACTIVE_ORDERS pedidos
+    status = random.choice(STATUSES[:2]) if i >= size - ACTIVE_ORDERS else random.choice(STATUSES[2:])
+    zone, delivery = random.choice(list(bot.ZONES.by_code.values()))
+    return {
+        "order_id": f"B{i:08d}", "user_id": random.randrange(users), "user_name": "Cliente",
+        "user_phone": "5555", "address": "Calle 1", "zone": zone,
+        "items": [{"id": "p1", "name": "Dulce", "price": 100, "qty": 2}], "subtotal": 200,
+        "delivery_cost": delivery, "total": 200 + delivery,
+        "status": status, "date": "01/01/2026 12:00",
+    }
+
+def fill_storage(path, backend, size):
+    store = bot.open_storage(path, backend)
+    users = max(size // 20, 1)
+    store.save({"menu": [], "orders": [fake_order(i, users, size) for i in range(size)]})
+    store.flush()
+    return bot.open_storage(path, backend), users
+
+def timed(fn, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+def bench_storage(args):
+    print(f"{'pedidos':>10} {'get_order':>12} {'user_orders':>12} {'activos':>12}   (µs por consulta)")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db" if args.backend == "sqlite" else "bench.json")
+            store, users = fill_storage(path, args.backend, size)
+            if args.backend == "json":
+                store.load()
+            ids = [f"B{random.randrange(size):08d}" for _ in range(args.rounds)]
+            it = iter(ids)
+            t_get = timed(lambda: store.get_order(next(it)), args.rounds)
+            t_user = timed(lambda: store.get_user_orders(random.randrange(users), 3), args.rounds)
+            t_active = timed(lambda: store.get_active_orders(1, after=random.randrange(size)), args.rounds)
+            print(f"{size:>10} {t_get:>12.1f} {t_user:>12.1f} {t_active:>12.1f}")
+            if args.backend == "sqlite":
+                store.db.close()
+
+# --- BOT DE PRUEBA ---
+# StubRequest sustituye la capa HTTP del bot: registra cada llamada a la Bot
+# API y devuelve una respuesta válida sin salir a la red.
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "DolceZZa", "username": "dolcezza_bot"}
+
+class StubRequest(BaseRequest):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[1]
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif endpoint.startswith(("send", "edit")):
+            chat_id = params.get("chat_id", 1)
+            result = {"message_id": self.calls.total(), "date": 0, "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER}
+            if endpoint == "sendMediaGroup":
+                result = [dict(result, message_id=result["message_id"] * 100 + i) for i in range(len(params["media"]))]
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+async def build_stub_application(latency=0.0):
+    request = StubRequest(latency)
+    application = Application.builder().token("123456:BENCH").request(request).get_updates_request(request).build()
+    await application.initialize()
+    return application, request
+
+def message_update(application, user_id, text, update_id=1):
+    """Update de un mensaje de texto del usuario en su chat privado"""
+    user = {"id": user_id, "is_bot": False, "first_name": f"Cliente {user_id}"}
+    message = {"message_id": update_id, "date": 0, "chat": {"id": user_id, "type": "private"}, "from": user, "text": text}
+    if text.startswith("/"):
+        # Sin la entidad bot_command los CommandHandler no reconocen el comando
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": update_id, "message": message}, application.bot)
+
+def callback_update(application, user_id, data, update_id=1, photo=False):
+    """Update de un toque de botón inline en el chat privado del usuario (en un mensaje con foto si `photo`)"""
+    user = {"id": user_id, "is_bot": False, "first_name": f"Cliente {user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    message = {"message_id": 1, "date": 0, "chat": chat, "from": BOT_USER, "text": "..."}
+    if photo:
+        message = {"message_id": 2, "date": 0, "chat": chat, "from": BOT_USER, "caption": "...",
+                   "photo": [{"file_id": "BENCHPHOTO", "file_unique_id": "bench", "width": 1, "height": 1}]}
+    payload = {
+        "update_id": update_id,
+        "callback_query": {"id": str(update_id), "from": user, "chat_instance": str(user_id), "data": data, "message": message},
+    }
+    return Update.de_json(payload, application.bot)
+
+async def run_handlers(args):
+    application, request = await build_stub_application()
+    bot.GALLERY_MODE = args.gallery
+    photo = "BENCHPHOTO" if args.photos else None
+    products = [bot.storage.add_product(f"Dulce {i}", 100 + i, photo) for i in range(args.menu)]
+    for name, handler, prefix in (("view_product", bot.view_product, "prod_"), ("add_to_cart", bot.add_to_cart, "addcart_")):
+        updates = [callback_update(application, random.randrange(args.users), prefix + random.choice(products)["id"], i) for i in range(args.rounds)]
+        start = time.perf_counter()
+        for update in updates:
+            await handler(update, CallbackContext.from_update(update, application))
+        elapsed = time.perf_counter() - start
+        print(f"{name:>14}: {elapsed / args.rounds * 1e6:8.1f} µs por toque ({args.menu} productos)")
+    print(f"Llamadas a la Bot API: {dict(request.calls)}")
+    await application.shutdown()
+
+def use_temp_data(tmp, flush_interval=0, backend="json"):
+    """Apunta la base de datos, la bandeja de salida y las sesiones del bot a una carpeta temporal"""
+    bot.storage = bot.open_storage(os.path.join(tmp, "bench.db" if backend == "sqlite" else "bench.json"), backend)
+    bot.outbox = bot.Outbox(os.path.join(tmp, "bench.json.outbox"))
+    bot.SESSIONS_FILE = os.path.join(tmp, "bench.sessions.db")
+    bot.FLUSH_INTERVAL = flush_interval
+
+def bench_handlers(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_data(tmp)
+        asyncio.run(run_handlers(args))
+
+# --- SIMULACIÓN DE CARGA ---
+# Cada cliente simulado recorre zona -> menú -> producto -> carrito -> checkout
+# y espera a que el bot termine cada paso antes de enviar el siguiente, como
+# una persona. Los admins simulados aceptan y entregan cada pedido según
+# llega. Todo pasa por la Application de build_application (handlers,
+# conversaciones, persistencia, bandeja de salida) con la Bot API simulada.
+# La latencia de un update va desde que entra en la cola hasta que terminan
+# todos sus handlers (o hasta que el límite de toques lo descarta); el
+# historial se precarga con `size` pedidos. Con --repeat cada toque de botón
+# se envía dos veces con esa probabilidad, como un doble toque impaciente.
+# Con --gallery los productos tienen foto y el cliente toca "Agregar" tres
+# veces en la ficha con foto, que no cambia, con GALLERY_TAP_PAUSE segundos
+# entre toques (como una persona; sin pausa la sesión pasa del límite de
+# ritmo). La columna "carritos" cuenta los pedidos que salen con todas las
+# unidades tocadas.
+
+CUSTOMER_BASE = 10 ** 8   # ids de clientes simulados, fuera del rango de los pedidos precargados
+ADMIN_BASE = 900000
+GALLERY_ADDS = 3
+GALLERY_TAP_PAUSE = 0.5
+
+def session_script(product_id, gallery=False):
+    zone = next(iter(bot.ZONES.by_code))
+    adds = [("photo", f"addcart_{product_id}")] * GALLERY_ADDS if gallery else [("cb", f"addcart_{product_id}")]
+    return [
+        ("cb", f"zone_{zone}"), ("cb", "view_menu"), ("cb", f"prod_{product_id}"), *adds,
+        ("cb", "view_cart"), ("cb", "start_checkout"), ("msg", "Cliente"), ("msg", "Calle 1"), ("msg", "5555"),
+        ("cb", "confirm_order_accept"),
+    ]
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class BenchApplication(Application):
+    """Application que avisa al terminar cada update, aunque el grupo -1 lo haya cortado"""
+    on_processed = None
+
+    async def process_update(self, update):
+        try:
+            await super().process_update(update)
+        finally:
+            if self.on_processed:
+                self.on_processed(update)
+
+class Simulation:
+    def __init__(self, application, think, repeat=0.0):
+        self.application = application
+        self.think = think
+        self.repeat = repeat
+        self.update_id = 0
+        self.repeated = 0
+        self.full_carts = 0
+        self.waiting = {}                               # update_id -> future que se resuelve al terminar
+        self.latencies = collections.defaultdict(list)  # "cliente"/"admin" -> segundos
+        self.orders = asyncio.Queue()
+        application.on_processed = self.finished
+
+    def finished(self, update):
+        future = self.waiting.pop(update.update_id, None)
+        if future:
+            future.set_result(None)
+
+    async def send(self, kind, user_id, data, role):
+        self.update_id += 1
+        if kind == "msg":
+            build = message_update
+        else:
+            build = functools.partial(callback_update, photo=kind == "photo")
+        update = build(self.application, user_id, data, self.update_id)
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[self.update_id] = future
+        start = time.perf_counter()
+        await self.application.update_queue.put(update)
+        if kind != "msg" and self.repeat and random.random() < self.repeat:
+            # Segundo toque sobre el mismo mensaje: nadie espera su resultado
+            self.update_id += 1
+            self.repeated += 1
+            await self.application.update_queue.put(build(self.application, user_id, data, self.update_id))
+        await future
+        self.latencies[role].append(time.perf_counter() - start)
+        if self.think:
+            await asyncio.sleep(random.uniform(0, self.think))
+
+    async def customer(self, user_id, products, gallery=False):
+        steps = session_script(random.choice(products)["id"], gallery)
+        for i, (kind, data) in enumerate(steps):
+            if i and steps[i - 1] == (kind, data):
+                await asyncio.sleep(GALLERY_TAP_PAUSE)
+            await self.send(kind, user_id, data, "cliente")
+        orders = bot.storage.get_user_orders(user_id, 1)
+        adds = sum(data.startswith("addcart_") for _, data in steps)
+        if orders and sum(item["qty"] for item in orders[0]["items"]) >= adds:
+            self.full_carts += 1
+        await self.orders.put(orders[0]["order_id"] if orders else None)
+
+    async def admin(self, admin_id):
+        while True:
+            order_id = await self.orders.get()
+            if order_id is not None:
+                await self.send("cb", admin_id, f"adm_accept_{order_id}", "admin")
+                await self.send("cb", admin_id, f"adm_done_{order_id}", "admin")
+            self.orders.task_done()
+
+async def run_load(workers, args):
+    bot.CONCURRENT_UPDATES = workers
+    # Cada corrida usa un bucle de eventos nuevo: los candados del bot se recrean para él
+    bot.DATA_LOCK = asyncio.Lock()
+    bot._notify_slots = asyncio.Semaphore(bot.NOTIFY_CONCURRENCY)
+    bot.ADMIN_IDS = [ADMIN_BASE + i for i in range(args.admins)]
+    bot.GALLERY_MODE = args.gallery
+    request = StubRequest(args.latency)
+    bot.rate_limiter = bot.RateLimiter(bot.RATE_LIMIT_RATE, bot.RATE_LIMIT_BURST)
+    bot.duplicates = bot.DuplicateGuard(bot.DUPLICATE_WINDOW)
+    builder = Application.builder().application_class(BenchApplication).token("123456:BENCH").request(request).get_updates_request(request)
+    application = bot.build_application(builder)
+    photo = "BENCHPHOTO" if args.gallery else None
+    products = [bot.storage.add_product(f"Dulce {i}", 100 + i, photo) for i in range(20)]
+    sim = Simulation(application, args.think, args.repeat)
+
+    _, delivered_before = bot.storage.get_balance()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    start = time.perf_counter()
+    admins = [asyncio.create_task(sim.admin(admin_id)) for admin_id in bot.ADMIN_IDS]
+    await asyncio.gather(*(sim.customer(CUSTOMER_BASE + i, products, args.gallery) for i in range(args.users)))
+    await sim.orders.join()
+    elapsed = time.perf_counter() - start
+    for task in admins:
+        task.cancel()
+    await application.stop()
+    await application.shutdown()
+    _, delivered = bot.storage.get_balance()
+    return sim, sim.update_id / elapsed, delivered - delivered_before
+
+def preload(size, backend):
+    """Llena la base temporal con `size` pedidos antiguos (sin contar en el tiempo medido)"""
+    if not size:
+        return
+    users = max(size // 20, 1)
+    bot.save_data({"menu": [], "orders": [fake_order(i, users, size) for i in range(size)]})
+    bot.storage.flush()
+
+def bench_load(args):
+    print(f"{args.users} clientes, {args.admins} admins, {args.latency * 1000:.0f} ms por llamada a la Bot API, backend {args.backend}")
+    print(f"{'pedidos':>10} {'workers':>8} {'updates/s':>10} {'p50 cli':>9} {'p99 cli':>9} {'p50 adm':>9} {'p99 adm':>9} {'entregados':>11} {'descartados':>12} {'carritos':>9}")
+    for size in args.sizes:
+        for workers in args.workers:
+            with tempfile.TemporaryDirectory() as tmp:
+                use_temp_data(tmp, flush_interval=60, backend=args.backend)
+                preload(size, args.backend)
+                dropped_before = sum(n for _, n in bot.metrics.series("updates_dropped_total"))
+                sim, rate, delivered = asyncio.run(run_load(workers, args))
+                dropped = sum(n for _, n in bot.metrics.series("updates_dropped_total")) - dropped_before
+                if args.backend == "sqlite":
+                    bot.storage.db.close()
+            ms = lambda role, q: percentile(sim.latencies[role], q) * 1000
+            print(f"{size:>10} {workers:>8} {rate:>10.1f} {ms('cliente', 0.5):>7.1f}ms {ms('cliente', 0.99):>7.1f}ms "
+                  f"{ms('admin', 0.5):>7.1f}ms {ms('admin', 0.99):>7.1f}ms {delivered:>7}/{args.users} {dropped:>6}/{sim.repeated} {sim.full_carts:>5}/{args.users}")
+
+# --- REINICIO A MITAD DEL CHECKOUT ---
+# Un cliente hace la sesión hasta escribir su dirección, el bot se apaga como
+# en un redespliegue y otra Application nueva (mismas SESSIONS_FILE y base)
+# recibe el teléfono y la confirmación. El pedido debe salir con la zona, el
+# carrito y los datos del checkout de antes del reinicio. Termina con código
+# 1 si no es así.
+
+async def start_app(application):
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+async def stop_app(application):
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+async def run_restart(args):
+    request = StubRequest()
+    builder = lambda: Application.builder().application_class(BenchApplication).token("123456:BENCH").request(request).get_updates_request(request)
+    product = bot.storage.add_product("Dulce", 150, None)
+    steps = session_script(product["id"])
+    user_id = CUSTOMER_BASE
+
+    first = bot.build_application(builder())
+    sim = Simulation(first, 0)
+    await start_app(first)
+    for kind, data in steps[:-2]:
+        await sim.send(kind, user_id, data, "cliente")
+    await stop_app(first)
+
+    second = bot.build_application(builder())
+    resumed = Simulation(second, 0)
+    resumed.update_id = sim.update_id
+    await start_app(second)
+    for kind, data in steps[-2:]:
+        await resumed.send(kind, user_id, data, "cliente")
+    await stop_app(second)
+
+    orders = bot.storage.get_user_orders(user_id, 1)
+    expected = {"user_name": "Cliente", "address": "Calle 1", "user_phone": "5555", "zone": next(iter(bot.ZONES.by_code.values()))[0]}
+    if not orders:
+        print("❌ Tras el reinicio el checkout no terminó en un pedido")
+        return 1
+    order = orders[0]
+    wrong = {k: order.get(k) for k, v in expected.items() if order.get(k) != v}
+    if wrong or [(i["id"], i["qty"]) for i in order["items"]] != [(product["id"], 1)]:
+        print(f"❌ El pedido no conserva la sesión previa al reinicio: {wrong or order['items']}")
+        return 1
+    print(f"✅ Checkout reanudado tras el reinicio: pedido #{order['order_id']} ({order['total']} CUP)")
+
+def bench_restart(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_data(tmp, backend=args.backend)
+        result = asyncio.run(run_restart(args))
+        if args.backend == "sqlite":
+            bot.storage.db.close()
+    return result
+
+# --- ARRANQUE EN FRÍO ---
+# Cada medición lanza un intérprete nuevo (bench.py startup --child) sobre una
+# base precargada y cuenta desde que se crea el proceso hasta que el bot
+# responde al primer /start: importaciones, build_application, initialize,
+# post_init (precalentado y consulta del webhook) y el primer update. El hijo
+# informa además del desglose y de lo que tarda el apagado ordenado. Si la
+# mediana supera el presupuesto el comando termina con código 1.
+
+# Medido: ~600 ms de mediana con 10 000 pedidos (JSON o SQLite), de los que
+# ~450 ms son arrancar Python e importar python-telegram-bot y ~120 ms leer la
+# base JSON en post_init. El presupuesto es el doble, para máquinas más lentas
+STARTUP_BUDGET_MS = 1200
+
+async def run_startup_child():
+    start = time.perf_counter()
+    phases = {}
+    def mark(name):
+        nonlocal start
+        now = time.perf_counter()
+        phases[name] = (now - start) * 1000
+        start = now
+
+    request = StubRequest()
+    builder = Application.builder().application_class(BenchApplication).token("123456:BENCH").request(request).get_updates_request(request)
+    application = bot.build_application(builder)
+    mark("build")
+    await application.initialize()
+    mark("initialize")
+    await application.post_init(application)
+    mark("post_init")
+    await application.start()
+    done = asyncio.get_running_loop().create_future()
+    application.on_processed = lambda update: done.done() or done.set_result(None)
+    await application.update_queue.put(message_update(application, CUSTOMER_BASE, "/start"))
+    await done
+    mark("primer update")
+    if not request.calls["sendMessage"]:
+        raise SystemExit("El bot no respondió al /start")
+    print(json.dumps(phases), flush=True)
+
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    mark("apagado")
+    print(json.dumps({"apagado": phases["apagado"]}), flush=True)
+
+def bench_startup(args):
+    if args.child:
+        asyncio.run(run_startup_child())
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db" if args.backend == "sqlite" else "bench.json")
+        store, _ = fill_storage(path, args.backend, args.size)
+        store.replace_menu([{"name": f"Dulce {i}", "price": 100 + i, "photo_id": None} for i in range(50)])
+        store.compact()
+        if args.backend == "sqlite":
+            store.db.close()
+        env = dict(os.environ, DATA_FILE=path, STORAGE_BACKEND=args.backend, FLUSH_INTERVAL="0", RENDER_EXTERNAL_URL="https://bench.invalid")
+
+        print(f"{args.size} pedidos, backend {args.backend}, presupuesto {args.budget:.0f} ms")
+        print(f"{'total':>9} {'build':>8} {'init':>8} {'post_init':>10} {'1er update':>11} {'apagado':>9}   (ms)")
+        totals = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "startup", "--child"], env=env, stdout=subprocess.PIPE, text=True)
+            line = child.stdout.readline()
+            total = (time.perf_counter() - start) * 1000
+            rest, _ = child.communicate()
+            if child.returncode or not line:
+                print(f"❌ El proceso de arranque falló (código {child.returncode})")
+                return 1
+            phases, shutdown = json.loads(line), json.loads(rest)
+            totals.append(total)
+            print(f"{total:>9.0f} {phases['build']:>8.0f} {phases['initialize']:>8.0f} {phases['post_init']:>10.0f} "
+                  f"{phases['primer update']:>11.0f} {shutdown['apagado']:>9.0f}")
+
+    median = percentile(totals, 0.5)
+    if median > args.budget:
+        print(f"❌ Arranque en frío: {median:.0f} ms de mediana, por encima del presupuesto de {args.budget:.0f} ms")
+        return 1
+    print(f"✅ Arranque en frío: {median:.0f} ms de mediana (presupuesto {args.budget:.0f} ms)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("storage", help="latencia de las consultas indexadas según el tamaño del historial")
+    p.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=[1000, 100000, 1000000])
+    p.add_argument("--backend", choices=["sqlite", "json"], default="sqlite")
+    p.add_argument("--rounds", type=int, default=2000)
+    p.set_defaults(func=bench_storage)
+
+    p = sub.add_parser("handlers", help="view_product y add_to_cart con Updates simulados")
+    p.add_argument("--menu", type=int, default=50)
+    p.add_argument("--rounds", type=int, default=5000)
+    p.add_argument("--users", type=int, default=1000, help="chats distintos entre los que se reparten los toques")
+    p.add_argument("--photos", action="store_true", help="productos con foto")
+    p.add_argument("--gallery", action="store_true", help="activa GALLERY_MODE")
+    p.set_defaults(func=bench_handlers)
+
+    p = sub.add_parser("load", help="sesiones completas de clientes y admins: updates/s y latencia p50/p99")
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--admins", type=int, default=4)
+    p.add_argument("--workers", type=lambda v: [int(x) for x in v.split(",")], default=[1, 4, 16, 64])
+    p.add_argument("--latency", type=float, default=0.02, help="segundos por llamada a la Bot API")
+    p.add_argument("--think", type=float, default=0.0, help="pausa máxima del usuario entre pasos, en segundos")
+    p.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=[1000, 100000, 1000000],
+                   help="pedidos precargados en el historial (una fila por tamaño)")
+    p.add_argument("--backend", choices=["sqlite", "json"], default="json")
+    p.add_argument("--repeat", type=float, default=0.0, help="probabilidad de que un toque de botón llegue repetido")
+    p.add_argument("--gallery", action="store_true", help="activa GALLERY_MODE y agrega desde la ficha con foto")
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("restart", help="reinicia el bot a mitad del checkout y comprueba que el pedido se completa")
+    p.add_argument("--backend", choices=["sqlite", "json"], default="json")
+    p.set_defaults(func=bench_restart)
+
+    p = sub.add_parser("startup", help="tiempo desde el arranque del proceso hasta la primera respuesta; falla si supera el presupuesto")
+    p.add_argument("--size", type=int, default=10000, help="pedidos precargados en la base")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--budget", type=float, default=STARTUP_BUDGET_MS, help="mediana máxima permitida, en ms")
+    p.add_argument("--backend", choices=["sqlite", "json"], default="json")
+    p.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    warnings.filterwarnings("ignore", category=PTBUserWarning)
+    random.seed(1)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,26 @@
+import asyncio
+import contextlib
+import csv
+import functools
+import gc
+import gzip
+import io
 import logging
 import os
 import json
-import uuid
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, ConversationHandler
+import signal
+import sqlite3
+import sys
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time as dtime, timedelta
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, InputMediaPhoto
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
+from telegram.ext import Application, ApplicationHandlerStop, BasePersistence, BaseUpdateProcessor, CommandHandler, PersistenceInput, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes, ConversationHandler
+from telegram.request import HTTPXRequest
 
 # --- CONFIGURACIÓN ---
 TOKEN = os.environ.get("TOKEN")
@@ -19,76 +35,1989 @@ if admins_str:
 DATA_FILE = os.environ.get("DATA_FILE", "database.json") 
 
 # --- TABLA DE ZONAS Y PRECIOS DE MENSAJERÍA ---
-ZONES_PRICES = {
-    "Centro Habana": 720,
-    "Vedado (hasta Paseo)": 780,
-    "Vedado (después de Paseo)": 840,
-    "Habana Vieja": 660,
-    "Cerro": 600,
-    "Nuevo Vedado": 840,
-    "Playa (Puente – Calle 60)": 1000, 
-    "Playa (Calle 60 – Paradero)": 1000, 
-    "Siboney": 1000, 
-    "Jaimanita": 1000, 
-    "Santa Fe": 1000, 
-    "Marianao (ITM)": 960,
-    "Marianao (100 y 51)": 1000, 
-    "Boyeros (Aeropuerto)": 600,
-    "Arroyo Naranjo (Los Pinos)": 300,
-    "Arroyo Naranjo (Mantilla)": 360,
-    "Arroyo Naranjo (Calvario)": 480,
-    "Arroyo Naranjo (Eléctrico)": 540,
-    "Diez de Octubre (Santo Suárez)": 420,
-    "Diez de Octubre (Lawton)": 540,
-    "San Miguel del Padrón (Virgen del Camino)": 720,
-    "Cotorro (Puente)": 900,
-    "Habana del Este (Regla)": 780,
-    "Habana del Este (Guanabo)": 1000, 
-    "Alamar (Zonas 9–11)": 1000 
+# La tabla vive en ZONES_FILE (zones.json junto a este archivo) y se recarga
+# sola cuando el archivo cambia, sin reiniciar el bot.
+ZONES_FILE = os.environ.get("ZONES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "zones.json"))
+ZONES_RELOAD_INTERVAL = int(os.environ.get("ZONES_RELOAD_INTERVAL", 30))
+
+# ESTADOS DE CONVERSACIÓN
+ADD_NAME, ADD_PRICE, ADD_PHOTO = range(3)
+CHK_NAME, CHK_ADDRESS, CHK_PHONE = range(3)
+
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# --- MÉTRICAS ---
+# Registro en memoria de latencias (histogramas) y contadores: duración de
+# cada handler, lecturas y escrituras del almacenamiento y llamadas a la Bot
+# API. Se consultan con /stats y, si METRICS_PATH está definido, en formato
+# Prometheus en el mismo puerto del webhook.
+
+METRICS_PATH = os.environ.get("METRICS_PATH", "")
+
+# Límites superiores de los buckets, en segundos
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    __slots__ = ("buckets", "count", "sum")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Límite superior del bucket donde cae el cuantil q (inf si supera el último)"""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS + (float("inf"),), self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metrics:
+    # Cada serie se identifica por (métrica, etiquetas), con las etiquetas como tupla ordenada de pares
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, metric, seconds, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.observe(seconds)
+
+    def inc(self, metric, value=1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def series(self, metric):
+        """Histogramas o contadores de una métrica: [(etiquetas, valor)]"""
+        source = self.histograms if metric in {m for m, _ in self.histograms} else self.counters
+        return [(dict(labels), value) for (m, labels), value in source.items() if m == metric]
+
+    @contextlib.contextmanager
+    def timer(self, metric, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(metric, time.perf_counter() - start, **labels)
+
+    def prometheus(self):
+        """Exposición en formato de texto de Prometheus"""
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+        
+        lines = ["# TYPE dulceria_uptime_seconds gauge", f"dulceria_uptime_seconds {time.time() - self.started:.0f}"]
+        for metric in sorted({m for m, _ in self.histograms}):
+            lines.append(f"# TYPE dulceria_{metric} histogram")
+            for (m, labels), hist in sorted(self.histograms.items()):
+                if m != metric:
+                    continue
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS, hist.buckets):
+                    cumulative += n
+                    lines.append(f"dulceria_{metric}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"dulceria_{metric}_bucket{fmt(labels, [('le', '+Inf')])} {hist.count}")
+                lines.append(f"dulceria_{metric}_sum{fmt(labels)} {hist.sum:.6f}")
+                lines.append(f"dulceria_{metric}_count{fmt(labels)} {hist.count}")
+        for metric in sorted({m for m, _ in self.counters}):
+            lines.append(f"# TYPE dulceria_{metric} counter")
+            for (m, labels), value in sorted(self.counters.items()):
+                if m == metric:
+                    lines.append(f"dulceria_{metric}{fmt(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# --- ZONAS DE ENTREGA ---
+# zones.json tiene la lista de zonas ({"code", "name", "price"}) y reglas
+# opcionales de mensajería. Las reglas se revisan en orden y gana la primera
+# que aplique:
+#
+#   {"zones": [1, 2], "from": "22:00", "to": "06:00", "min_subtotal": 5000, "extra": 200}
+#
+# Todos los filtros son opcionales (sin "zones" aplica a todas; el horario
+# puede cruzar la medianoche). "price" fija la mensajería y "extra" la suma al
+# precio de la zona (negativo = descuento). Al cargar, las reglas se compilan
+# en una tabla por zona y minuto del día con los umbrales de subtotal, así que
+# calcular la mensajería en el checkout es una consulta directa.
+
+CALLBACK_DATA_MAX = 64  # bytes, límite de la Bot API
+
+def check_callback_data(data):
+    if len(data.encode("utf-8")) > CALLBACK_DATA_MAX:
+        raise ValueError(f"callback_data de más de {CALLBACK_DATA_MAX} bytes: {data!r}")
+    return data
+
+def parse_hhmm(value):
+    """'HH:MM' -> minuto del día"""
+    hours, minutes = (int(x) for x in str(value).split(":"))
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"hora inválida: {value!r}")
+    return hours * 60 + minutes
+
+def _int_field(entry, key, where, minimum=None):
+    if key not in entry:
+        raise ValueError(f"{where}: falta '{key}'")
+    value = entry[key]
+    if not isinstance(value, int) or isinstance(value, bool) or (minimum is not None and value < minimum):
+        raise ValueError(f"{where}: '{key}' debe ser un entero" + (f" >= {minimum}" if minimum is not None else ""))
+    return value
+
+class ZoneTable:
+    def __init__(self, config):
+        self.by_code = {}       # código -> (nombre, precio base)
+        self.code_by_name = {}
+        for i, zone in enumerate(config.get("zones") or []):
+            where = f"zona {i + 1}"
+            code = _int_field(zone, "code", where, minimum=1)
+            name = str(zone.get("name") or "").strip()
+            if not name:
+                raise ValueError(f"{where}: falta el nombre")
+            if code in self.by_code or name in self.code_by_name:
+                raise ValueError(f"{where}: código o nombre repetido")
+            check_callback_data(f"zone_{code}")
+            self.by_code[code] = (name, _int_field(zone, "price", where, minimum=0))
+            self.code_by_name[name] = code
+        if not self.by_code:
+            raise ValueError("no hay zonas")
+        
+        self.rules = []
+        for i, rule in enumerate(config.get("rules") or []):
+            where = f"regla {i + 1}"
+            zones = rule.get("zones")
+            if zones is not None and not set(zones) <= set(self.by_code):
+                raise ValueError(f"{where}: zonas desconocidas {sorted(set(zones) - set(self.by_code))}")
+            if ("from" in rule) != ("to" in rule):
+                raise ValueError(f"{where}: 'from' y 'to' van juntos")
+            if ("price" in rule) == ("extra" in rule):
+                raise ValueError(f"{where}: debe tener 'price' o 'extra'")
+            self.rules.append({
+                "zones": set(zones) if zones is not None else None,
+                "from": parse_hhmm(rule["from"]) if "from" in rule else None,
+                "to": parse_hhmm(rule["to"]) if "to" in rule else None,
+                "min_subtotal": _int_field(rule, "min_subtotal", where, minimum=0) if "min_subtotal" in rule else 0,
+                "price": _int_field(rule, "price", where, minimum=0) if "price" in rule else None,
+                "extra": _int_field(rule, "extra", where) if "extra" in rule else 0,
+            })
+        
+        self.table = self._compile()
+        self.keyboard = self._build_keyboard()
+
+    @staticmethod
+    def _in_hours(rule, minute):
+        if rule["from"] is None:
+            return True
+        if rule["from"] <= rule["to"]:
+            return rule["from"] <= minute < rule["to"]
+        return minute >= rule["from"] or minute < rule["to"]
+
+    def _compile(self):
+        """código -> lista de 1440 entradas (umbrales de subtotal, mensajería para cada umbral)"""
+        by_minute = [tuple(i for i, r in enumerate(self.rules) if self._in_hours(r, m)) for m in range(1440)]
+        table = {}
+        for code, (_, base) in self.by_code.items():
+            # Pocos horarios distintos: cada combinación de reglas se calcula una vez y se comparte entre minutos
+            compiled = {}
+            for active in set(by_minute):
+                rules = [i for i in active if self.rules[i]["zones"] is None or code in self.rules[i]["zones"]]
+                thresholds = sorted({0} | {self.rules[i]["min_subtotal"] for i in rules})
+                compiled[active] = (thresholds, [self._evaluate(rules, base, t) for t in thresholds])
+            table[code] = [compiled[active] for active in by_minute]
+        return table
+
+    def _evaluate(self, rules, base, subtotal):
+        for i in rules:
+            rule = self.rules[i]
+            if subtotal >= rule["min_subtotal"]:
+                cost = rule["price"] if rule["price"] is not None else base + rule["extra"]
+                return max(cost, 0)
+        return base
+
+    def _build_keyboard(self):
+        buttons = [InlineKeyboardButton(name, callback_data=f"zone_{code}") for code, (name, _) in self.by_code.items()]
+        return InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+
+    def resolve(self, user_data):
+        """Código de la zona del cliente (o None si ya no existe); actualiza el nombre si cambió"""
+        code = user_data.get("zone_code")
+        if code not in self.by_code:
+            # Sesiones anteriores a los códigos solo guardaban el nombre
+            code = self.code_by_name.get(user_data.get("zone"))
+            if code is None:
+                return None
+        user_data["zone_code"] = code
+        user_data["zone"] = self.by_code[code][0]
+        return code
+
+    def delivery(self, code, subtotal, when=None):
+        when = when or datetime.now()
+        thresholds, costs = self.table[code][when.hour * 60 + when.minute]
+        return costs[bisect_right(thresholds, subtotal) - 1]
+
+ZONES = None
+_zones_mtime = None
+
+def reload_zones():
+    """Carga ZONES_FILE si cambió desde la última lectura; devuelve True si se recargó"""
+    global ZONES, _zones_mtime
+    mtime = os.stat(ZONES_FILE).st_mtime_ns
+    if mtime == _zones_mtime:
+        return False
+    # Se anota antes de leer para no reintentar un archivo inválido hasta que se corrija
+    _zones_mtime = mtime
+    with open(ZONES_FILE, "r", encoding="utf-8") as f:
+        ZONES = ZoneTable(json.load(f))
+    return True
+
+async def zones_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if reload_zones():
+            logger.info("Tabla de zonas recargada: %d zonas, %d reglas", len(ZONES.by_code), len(ZONES.rules))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.error("No se pudo recargar %s, se mantiene la tabla anterior: %s", ZONES_FILE, e)
+
+reload_zones()
+
+# --- BASE DE DATOS ---
+# El almacenamiento es intercambiable: STORAGE_BACKEND ("json" o "sqlite")
+# elige el motor y, si no se indica, se deduce de la extensión de DATA_FILE
+# (.db/.sqlite/.sqlite3 usan SQLite). Los handlers solo usan los métodos de
+# consulta y modificación del objeto `storage`. Para reemplazar la base
+# completa se usa save_data(), que además olvida las reservas y el teclado del
+# menú calculados con la base anterior.
+#
+# JSON: los datos se leen del disco una sola vez y quedan residentes en
+# memoria. Cada cambio se registra como un evento en un diario (JSON Lines)
+# que solo crece por el final, así que escribir un pedido cuesta lo mismo sin
+# importar el historial acumulado. Un job periódico vuelca los eventos
+# pendientes cada FLUSH_INTERVAL segundos (0 = escritura inmediata) y otro
+# compacta el diario en DATA_FILE cada COMPACT_INTERVAL segundos. La
+# compactación corre entera en el hilo de escritura: lee la foto y el diario
+# del disco, los pliega y escribe la foto nueva, sin tocar los datos que usan
+# los handlers. La foto guarda un pedido por línea (sigue siendo un JSON
+# normal), así se lee y se escribe por partes pequeñas sin retener el GIL
+# durante segundos. Al arrancar se lee DATA_FILE y se reproducen los eventos
+# posteriores a esa foto.
+#
+# SQLite: modo WAL con índices por order_id, user_id y estado.
+
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", 5))
+COMPACT_INTERVAL = float(os.environ.get("COMPACT_INTERVAL", 3600))
+JOURNAL_FILE = os.environ.get("JOURNAL_FILE", f"{DATA_FILE}.journal")
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND")
+
+ACTIVE_STATUSES = ("PENDIENTE", "ACEPTADO")
+TERMINAL_STATUSES = ("REALIZADO", "RECHAZADO")
+# Estados desde los que se permite cada acción del admin
+ORDER_TRANSITIONS = {"accept": ("PENDIENTE",), "reject": ("PENDIENTE",), "done": ("ACEPTADO",)}
+
+def short_id(n):
+    """Id compacto en base 36 (1 -> "1", 36 -> "10") para no acercarse al límite de 64 bytes de callback_data"""
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    text = ""
+    while True:
+        n, r = divmod(n, 36)
+        text = digits[r] + text
+        if not n:
+            return text
+
+# --- BALANCE ACUMULADO ---
+# Las ventas se acumulan cuando un pedido pasa a REALIZADO (total, por zona y
+# por día de entrega) y se guardan junto a los datos, así el balance no tiene
+# que recorrer el historial de pedidos. El día de entrega queda en el pedido
+# (delivered_at) para que reconstruir el acumulado dé lo mismo; los pedidos
+# entregados antes de guardarlo cuentan por el día en que se hicieron.
+
+def empty_stats():
+    return {"delivered": 0, "revenue": 0, "by_zone": {}, "by_day": {}}
+
+def order_day(order):
+    """Día (AAAA-MM-DD) en que se hizo el pedido"""
+    try:
+        return datetime.strptime(order["date"], "%d/%m/%Y %H:%M").strftime("%Y-%m-%d")
+    except (KeyError, ValueError):
+        return datetime.now().strftime("%Y-%m-%d")
+
+def sale_day(order):
+    """Día (AAAA-MM-DD) en que cuenta la venta de un pedido entregado"""
+    return order.get("delivered_at") or order_day(order)
+
+def add_sale(stats, zone, day, total):
+    stats["delivered"] += 1
+    stats["revenue"] += total
+    for table, key in (("by_zone", zone), ("by_day", day)):
+        row = stats[table].setdefault(key, [0, 0])
+        row[0] += 1
+        row[1] += total
+
+def build_stats(orders):
+    """Reconstruye el acumulado desde los pedidos (solo para bases antiguas sin él)"""
+    stats = empty_stats()
+    for order in orders:
+        if order["status"] == "REALIZADO":
+            add_sale(stats, order["zone"], sale_day(order), order["total"])
+    return stats
+
+def date_range(start, end):
+    day = datetime.strptime(start, "%Y-%m-%d")
+    last = datetime.strptime(end, "%Y-%m-%d")
+    while day <= last:
+        yield day.strftime("%Y-%m-%d")
+        day += timedelta(days=1)
+
+SNAPSHOT_ORDERS_KEY = ', "orders": [\n'
+
+def snapshot_chunks(data):
+    """Foto de la base como JSON válido con un pedido por línea, en trozos"""
+    head = json.dumps({k: v for k, v in data.items() if k != "orders"}, ensure_ascii=False)
+    yield (head[:-1] + SNAPSHOT_ORDERS_KEY) if head != "{}" else SNAPSHOT_ORDERS_KEY.replace(", ", "{", 1)
+    for i, order in enumerate(data["orders"]):
+        yield (",\n" if i else "") + json.dumps(order, ensure_ascii=False)
+    yield "\n]}\n"
+
+def read_snapshot(path):
+    """Lee una foto pedido a pedido (las escritas con indentación se leen de una vez)"""
+    with open(path, "r", encoding="utf-8") as f:
+        first = f.readline()
+        if not first.endswith(SNAPSHOT_ORDERS_KEY):
+            f.seek(0)
+            return json.load(f)
+        head = first[:-len(SNAPSHOT_ORDERS_KEY)]
+        data = json.loads(head + "}") if head != "{" else {}
+        data["orders"] = orders = []
+        for line in f:
+            line = line.rstrip().rstrip(",")
+            if not line:
+                continue
+            if line == "]}":
+                return data
+            orders.append(json.loads(line))
+    raise ValueError(f"Foto incompleta: {path}")
+
+def write_atomic(path, text):
+    """Escribe a un temporal en la misma carpeta, lo sincroniza y lo renombra sobre el destino (texto o trozos)"""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.writelines([text] if isinstance(text, str) else text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def make_order_id(seq):
+    """Id de pedido: fecha + contador global que nunca se repite (ej: 20260115-42)"""
+    return f"{datetime.now():%Y%m%d}-{seq}"
+
+class JsonStorage:
+    def __init__(self, path, journal_path=None):
+        self.path = path
+        self.journal_path = journal_path or f"{path}.journal"
+        self.data = None
+        self.menu_index = {}       # id -> producto
+        self.orders_by_id = {}
+        self.orders_by_user = {}   # user_id -> pedidos ordenados por seq
+        self.active_seqs = []      # seq de los pedidos PENDIENTE / ACEPTADO, ordenados
+        self.active_by_seq = {}    # seq -> pedido activo
+        self.snapshot_dirty = False # hay que reescribir el archivo completo
+        self.compaction_pending = False
+        self.journal_pending = []   # líneas del diario aún no escritas
+        self.journal_size = 0       # eventos en el diario desde la última compactación
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="data-writer")
+
+    def _read_file(self, strict=False):
+        if not os.path.exists(self.path):
+            return {"menu": [], "orders": []}
+        try:
+            return read_snapshot(self.path)
+        except:
+            if strict:
+                raise
+            return {"menu": [], "orders": []}
+
+    def _index(self, data):
+        if "order_seq" not in data:
+            # Base antigua: se numeran los pedidos en el orden en que se guardaron
+            for i, order in enumerate(data["orders"]):
+                order["seq"] = i + 1
+            data["order_seq"] = len(data["orders"])
+        self.menu_index = {p["id"]: p for p in data["menu"]}
+        self.orders_by_id.clear()
+        self.orders_by_user.clear()
+        self.active_seqs.clear()
+        self.active_by_seq.clear()
+        for order in data["orders"]:
+            self._index_order(order)
+
+    def _index_order(self, order):
+        self.orders_by_id[order["order_id"]] = order
+        self.orders_by_user.setdefault(order["user_id"], []).append(order)
+        if order["status"] in ACTIVE_STATUSES:
+            self._activate(order)
+
+    def _activate(self, order):
+        if order["seq"] not in self.active_by_seq:
+            insort(self.active_seqs, order["seq"])
+            self.active_by_seq[order["seq"]] = order
+
+    def _deactivate(self, order):
+        if self.active_by_seq.pop(order["seq"], None) is not None:
+            del self.active_seqs[bisect_left(self.active_seqs, order["seq"])]
+
+    def _apply(self, event):
+        data = self.data
+        op = event["op"]
+        if op == "order_new":
+            if event["order"]["order_id"] not in self.orders_by_id:
+                data["orders"].append(event["order"])
+                self._index_order(event["order"])
+                data["order_seq"] += 1
+        elif op == "order_status":
+            order = self.orders_by_id.get(event["order_id"])
+            if order:
+                if event["status"] == "REALIZADO" and order["status"] != "REALIZADO":
+                    order["delivered_at"] = event["day"]
+                    add_sale(data["stats"], order["zone"], event["day"], order["total"])
+                order["status"] = event["status"]
+                if order["status"] in ACTIVE_STATUSES:
+                    self._activate(order)
+                else:
+                    self._deactivate(order)
+        elif op == "order_archive":
+            archived = set(event["order_ids"])
+            data["orders"] = [o for o in data["orders"] if o["order_id"] not in archived]
+            for order_id in archived:
+                order = self.orders_by_id.pop(order_id, None)
+                if order:
+                    self._deactivate(order)
+                    self.orders_by_user[order["user_id"]].remove(order)
+        elif op == "menu_add":
+            data["menu"].append(event["item"])
+            self.menu_index[event["item"]["id"]] = event["item"]
+            data["product_seq"] = data.get("product_seq", 0) + 1
+        elif op == "menu_clear":
+            data["menu"] = []
+            self.menu_index.clear()
+        elif op == "menu_replace":
+            data["menu"] = event["menu"]
+            self.menu_index = {p["id"]: p for p in data["menu"]}
+            data["product_seq"] = event["product_seq"]
+        elif op == "stock":
+            for product_id, stock in event["stock"].items():
+                if product_id in self.menu_index:
+                    self.menu_index[product_id]["stock"] = stock
+        data["seq"] = event["seq"]
+
+    def _replay_journal(self):
+        """Aplica los eventos del diario que no estén ya incluidos en la foto"""
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # Última línea cortada por un apagado brusco
+                    break
+                self.journal_size += 1
+                if event["seq"] > self.data.get("seq", 0):
+                    self._apply(event)
+
+    def warm(self):
+        """Lee e indexa la base para que el primer update no pague la carga"""
+        self.load()
+
+    def _read_all(self, strict=False):
+        self.data = self._read_file(strict)
+        if "stats" not in self.data:
+            self.data["stats"] = build_stats(self.data["orders"])
+        self._index(self.data)
+        self._replay_journal()
+
+    def load(self):
+        if self.data is None:
+            with metrics.timer("storage_seconds", op="load"):
+                self._read_all()
+            size = sum(os.path.getsize(p) for p in (self.path, self.journal_path) if os.path.exists(p))
+            metrics.inc("storage_bytes_total", size, op="load")
+        return self.data
+
+    def save(self, data):
+        """Reemplaza la base de datos completa (se reescribe en el próximo volcado)"""
+        if "stats" not in data:
+            data["stats"] = build_stats(data["orders"])
+        self.data = data
+        self._index(data)
+        self.snapshot_dirty = True
+        if FLUSH_INTERVAL <= 0:
+            self.flush()
+
+    def _commit(self, event):
+        data = self.load()
+        event["seq"] = data.get("seq", 0) + 1
+        self._apply(event)
+        self.journal_pending.append(json.dumps(event, ensure_ascii=False) + "\n")
+        self.journal_size += 1
+        if FLUSH_INTERVAL <= 0:
+            self.flush()
+
+    # --- Consultas ---
+
+    def get_menu(self):
+        return self.load()["menu"]
+
+    def get_product(self, product_id):
+        self.load()
+        return self.menu_index.get(product_id)
+
+    def get_order(self, order_id):
+        self.load()
+        return self.orders_by_id.get(order_id)
+
+    # Las consultas paginadas usan `seq` como cursor y solo tocan la página pedida
+
+    def get_user_orders(self, user_id, limit, before=None):
+        """Hasta `limit` pedidos del usuario con seq < before, del más nuevo al más viejo"""
+        self.load()
+        orders = self.orders_by_user.get(user_id, [])
+        end = len(orders) if before is None else bisect_left(orders, before, key=lambda o: o["seq"])
+        return orders[max(end - limit, 0):end][::-1]
+
+    def get_user_orders_after(self, user_id, after, limit):
+        """Hasta `limit` pedidos del usuario con seq > after, del más viejo al más nuevo"""
+        self.load()
+        orders = self.orders_by_user.get(user_id, [])
+        start = bisect_right(orders, after, key=lambda o: o["seq"])
+        return orders[start:start + limit]
+
+    def get_active_orders(self, limit, after=0):
+        """Hasta `limit` pedidos activos con seq > after, del más viejo al más nuevo"""
+        self.load()
+        start = bisect_right(self.active_seqs, after)
+        return [self.active_by_seq[seq] for seq in self.active_seqs[start:start + limit]]
+
+    def get_active_orders_before(self, before, limit):
+        """Hasta `limit` pedidos activos con seq < before, del más nuevo al más viejo"""
+        self.load()
+        end = bisect_left(self.active_seqs, before)
+        return [self.active_by_seq[seq] for seq in self.active_seqs[max(end - limit, 0):end][::-1]]
+
+    def iter_orders(self):
+        return iter(self.load()["orders"])
+
+    def iter_orders_desc(self):
+        """Pedidos del más nuevo al más viejo (los nuevos que entren mientras tanto no aparecen)"""
+        return reversed(self.load()["orders"])
+
+    def get_balance(self):
+        stats = self.load()["stats"]
+        return stats["revenue"], stats["delivered"]
+
+    def get_balance_between(self, start, end):
+        """Recaudado y entregados entre dos días (AAAA-MM-DD, ambos incluidos)"""
+        by_day = self.load()["stats"]["by_day"]
+        total, count = 0, 0
+        for day in date_range(start, end):
+            if day in by_day:
+                count += by_day[day][0]
+                total += by_day[day][1]
+        return total, count
+
+    def get_balance_by_zone(self):
+        """Lista de (zona, entregados, recaudado)"""
+        return [(zone, row[0], row[1]) for zone, row in self.load()["stats"]["by_zone"].items()]
+
+    async def get_archivable_orders_async(self, cutoff):
+        """Pedidos terminados hechos antes del día `cutoff` (AAAA-MM-DD)"""
+        # Se filtra una copia de la lista en un hilo: los pedidos nuevos del bucle no la alteran
+        orders = list(self.load()["orders"])
+        return await asyncio.to_thread(
+            lambda: [o for o in orders if o["status"] in TERMINAL_STATUSES and order_day(o) < cutoff])
+
+    # --- Modificaciones ---
+
+    def remove_orders(self, order_ids):
+        """Quita pedidos de la base activa (ya copiados al archivo)"""
+        self._commit({"op": "order_archive", "order_ids": list(order_ids)})
+
+    def add_order(self, order):
+        """Guarda un pedido nuevo asignándole un order_id único; devuelve ese id"""
+        order["seq"] = self.load()["order_seq"] + 1
+        order["order_id"] = make_order_id(order["seq"])
+        self._commit({"op": "order_new", "order": order})
+        return order["order_id"]
+
+    def set_order_status(self, order_id, status):
+        self._commit({"op": "order_status", "order_id": order_id, "status": status, "day": datetime.now().strftime("%Y-%m-%d")})
+
+    def add_product(self, name, price, photo_id):
+        """Agrega un producto con un id corto nuevo (nunca se reutiliza) y lo devuelve"""
+        item = {"id": short_id(self.load().get("product_seq", 0) + 1), "name": name, "price": price, "photo_id": photo_id}
+        self._commit({"op": "menu_add", "item": item})
+        return item
+
+    def clear_menu(self):
+        self._commit({"op": "menu_clear"})
+
+    def replace_menu(self, items):
+        """Sustituye el menú completo en un solo evento; los productos sin id reciben uno nuevo"""
+        seq = self.load().get("product_seq", 0)
+        menu = []
+        for item in items:
+            if not item.get("id"):
+                seq += 1
+                item = dict(item, id=short_id(seq))
+            menu.append(item)
+        self._commit({"op": "menu_replace", "menu": menu, "product_seq": seq})
+        return menu
+
+    def set_stock(self, changes):
+        """Fija el stock de varios productos ({id: unidades}, None = sin límite)"""
+        self._commit({"op": "stock", "stock": changes})
+
+    # --- Escritura a disco ---
+
+    def take_pending(self):
+        """Devuelve el trabajo de escritura pendiente: ("snapshot", texto), ("compact" o "journal", líneas) o None"""
+        if self.snapshot_dirty:
+            self.snapshot_dirty = False
+            self.compaction_pending = False
+            self.journal_pending.clear()
+            self.journal_size = 0
+            return "snapshot", "".join(snapshot_chunks(self.data))
+        if self.compaction_pending:
+            self.compaction_pending = False
+            lines = self.journal_pending[:]
+            self.journal_pending.clear()
+            self.journal_size = 0
+            return "compact", lines
+        if self.journal_pending:
+            lines = self.journal_pending[:]
+            self.journal_pending.clear()
+            return "journal", lines
+        return None
+
+    def write_pending(self, pending):
+        kind, payload = pending
+        start = time.perf_counter()
+        if kind == "journal" or (kind == "compact" and payload):
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                offset = f.tell()
+                f.writelines(payload)
+                f.flush()
+                os.fsync(f.fileno())
+                written = f.tell() - offset
+        if kind != "journal":
+            # Al plegar se crean millones de objetos y el recolector de ciclos los
+            # recorrería reteniendo el GIL cientos de ms; los datos no forman ciclos
+            # y se liberan solos, así que se pausa mientras dura
+            paused = kind == "compact" and gc.isenabled()
+            if paused:
+                gc.disable()
+            try:
+                if kind == "compact":
+                    # Foto anterior + diario, leídos del disco en este hilo: los datos en memoria no se
+                    # tocan. Una foto ilegible lanza error en vez de sustituirse por otra vacía
+                    folded = JsonStorage(self.path, self.journal_path)
+                    folded._read_all(strict=True)
+                    payload = snapshot_chunks(folded.data)
+                # Se escribe a un temporal y se renombra: un corte a mitad nunca deja el archivo truncado
+                write_atomic(self.path, payload)
+                if kind == "compact":
+                    # La copia se suelta por partes: liberarla de golpe también retiene el GIL
+                    for index in (folded.orders_by_id, folded.orders_by_user, folded.active_by_seq):
+                        index.clear()
+                    orders = folded.data["orders"]
+                    while orders:
+                        del orders[-1000:]
+            finally:
+                if paused:
+                    gc.enable()
+            # La foto ya contiene todos los eventos: el diario puede empezar de cero
+            open(self.journal_path, "w").close()
+            written = os.path.getsize(self.path)
+        metrics.observe("storage_seconds", time.perf_counter() - start, op=kind)
+        metrics.inc("storage_bytes_total", written, op=kind)
+
+    # Todas las escrituras pasan por un único hilo, en el mismo orden en que se
+    # tomaron, así un lote del diario nunca se adelanta a otro anterior.
+
+    def flush(self):
+        pending = self.take_pending()
+        if pending:
+            self.writer.submit(self.write_pending, pending).result()
+
+    async def flush_async(self):
+        # Se serializa en el hilo principal (foto consistente) y se escribe en el hilo de escritura
+        pending = self.take_pending()
+        if pending:
+            await asyncio.get_running_loop().run_in_executor(self.writer, self.write_pending, pending)
+
+    def request_compaction(self):
+        """Pliega el diario en el archivo principal en el próximo volcado"""
+        if self.journal_size or self.journal_pending:
+            self.compaction_pending = True
+
+    def compact(self):
+        self.request_compaction()
+        self.flush()
+
+    async def compact_async(self):
+        self.request_compaction()
+        await self.flush_async()
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS menu (
+    pos INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    price INTEGER NOT NULL,
+    photo_id TEXT,
+    stock INTEGER
+);
+CREATE TABLE IF NOT EXISTS orders (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id TEXT UNIQUE NOT NULL,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    day TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id, seq);
+CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, seq);
+CREATE TABLE IF NOT EXISTS sales (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    revenue INTEGER NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+"""
+
+class SqliteStorage:
+    def __init__(self, path):
+        self.path = path
+        with metrics.timer("storage_seconds", op="load"):
+            self.db = sqlite3.connect(path)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SQLITE_SCHEMA)
+            if "stock" not in {r[1] for r in self.db.execute("PRAGMA table_info(menu)")}:
+                # Bases creadas antes de llevar existencias
+                self.db.execute("ALTER TABLE menu ADD COLUMN stock INTEGER")
+            if "day" not in {r[1] for r in self.db.execute("PRAGMA table_info(orders)")}:
+                # Bases creadas antes de guardar el día del pedido en su columna
+                with self.db:
+                    self.db.execute("ALTER TABLE orders ADD COLUMN day TEXT")
+                    rows = self.db.execute("SELECT seq, status, doc FROM orders").fetchall()
+                    self.db.executemany("UPDATE orders SET day = ? WHERE seq = ?",
+                                        ((order_day(o), o["seq"]) for o in map(self._order, rows)))
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_orders_day ON orders (status, day)")
+        metrics.inc("storage_bytes_total", os.path.getsize(path), op="load")
+        self.menu = None        # copia en memoria del menú (es pequeño y se lee en cada toque)
+        self.menu_index = {}
+
+    @staticmethod
+    def _order(row):
+        seq, status, doc = row
+        order = json.loads(doc)
+        order["seq"] = seq
+        order["status"] = status
+        return order
+
+    def _active_page(self, where, order_by, params, limit):
+        # Una consulta por estado sobre el índice (status, seq) y se combinan: coste O(página)
+        rows = []
+        for status in ACTIVE_STATUSES:
+            rows += self.db.execute(f"SELECT seq, status, doc FROM orders WHERE status = ? AND {where} ORDER BY {order_by} LIMIT ?",
+                                    (status, *params, limit)).fetchall()
+        rows.sort(key=lambda r: r[0], reverse=order_by.endswith("DESC"))
+        return [self._order(r) for r in rows[:limit]]
+
+    def load(self):
+        return {"menu": self.get_menu(), "orders": list(self.iter_orders()), "stats": self._stats()}
+
+    def warm(self):
+        """Carga el menú y trae a caché las páginas del índice de pedidos activos"""
+        self.get_menu()
+        self.get_active_orders(1)
+
+    def _stats(self):
+        stats = empty_stats()
+        for kind, key, count, revenue in self.db.execute("SELECT kind, key, count, revenue FROM sales"):
+            if kind == "total":
+                stats["delivered"], stats["revenue"] = count, revenue
+            else:
+                stats[f"by_{kind}"][key] = [count, revenue]
+        return stats
+
+    def _add_sale(self, zone, day, total):
+        self.db.executemany(
+            "INSERT INTO sales (kind, key, count, revenue) VALUES (?, ?, 1, ?) "
+            "ON CONFLICT (kind, key) DO UPDATE SET count = count + 1, revenue = revenue + excluded.revenue",
+            (("total", "", total), ("zone", zone, total), ("day", day, total)))
+
+    def save(self, data):
+        with self.db:
+            self.db.execute("DELETE FROM menu")
+            self.db.execute("DELETE FROM orders")
+            self.db.execute("DELETE FROM sales")
+            self.db.executemany(
+                "INSERT INTO menu (id, name, price, photo_id, stock) VALUES (?, ?, ?, ?, ?)",
+                ((p["id"], p["name"], p["price"], p.get("photo_id"), p.get("stock")) for p in data["menu"]))
+            self.menu = None
+            self.db.executemany(
+                "INSERT INTO orders (seq, order_id, user_id, status, doc, day) VALUES (?, ?, ?, ?, ?, ?)",
+                ((o.get("seq"), o["order_id"], o["user_id"], o["status"], json.dumps(o, ensure_ascii=False), order_day(o))
+                 for o in data["orders"]))
+            stats = data.get("stats") or build_stats(data["orders"])
+            rows = [("total", "", stats["delivered"], stats["revenue"])]
+            for kind in ("zone", "day"):
+                rows.extend((kind, key, row[0], row[1]) for key, row in stats[f"by_{kind}"].items())
+            self.db.executemany("INSERT INTO sales (kind, key, count, revenue) VALUES (?, ?, ?, ?)", rows)
+
+    # --- Consultas ---
+
+    def get_menu(self):
+        if self.menu is None:
+            rows = self.db.execute("SELECT id, name, price, photo_id, stock FROM menu ORDER BY pos")
+            self.menu = [{"id": r[0], "name": r[1], "price": r[2], "photo_id": r[3], "stock": r[4]} for r in rows]
+            self.menu_index = {p["id"]: p for p in self.menu}
+        return self.menu
+
+    def get_product(self, product_id):
+        self.get_menu()
+        return self.menu_index.get(product_id)
+
+    def get_order(self, order_id):
+        row = self.db.execute("SELECT seq, status, doc FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        return self._order(row) if row else None
+
+    def get_user_orders(self, user_id, limit, before=None):
+        rows = self.db.execute("SELECT seq, status, doc FROM orders WHERE user_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                               (user_id, before if before is not None else sys.maxsize, limit))
+        return [self._order(r) for r in rows]
+
+    def get_user_orders_after(self, user_id, after, limit):
+        rows = self.db.execute("SELECT seq, status, doc FROM orders WHERE user_id = ? AND seq > ? ORDER BY seq LIMIT ?", (user_id, after, limit))
+        return [self._order(r) for r in rows]
+
+    def get_active_orders(self, limit, after=0):
+        return self._active_page("seq > ?", "seq", (after,), limit)
+
+    def get_active_orders_before(self, before, limit):
+        return self._active_page("seq < ?", "seq DESC", (before,), limit)
+
+    def iter_orders(self):
+        for row in self.db.execute("SELECT seq, status, doc FROM orders ORDER BY seq"):
+            yield self._order(row)
+
+    def iter_orders_desc(self, batch=500):
+        # Por páginas sobre la clave primaria: ningún cursor queda abierto entre una página y otra
+        cursor = None
+        while True:
+            where = "WHERE seq < ?" if cursor else ""
+            rows = self.db.execute(f"SELECT seq, status, doc FROM orders {where} ORDER BY seq DESC LIMIT ?",
+                                   (cursor, batch) if cursor else (batch,)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield self._order(row)
+            cursor = rows[-1][0]
+
+    def get_balance(self):
+        row = self.db.execute("SELECT revenue, count FROM sales WHERE kind = 'total'").fetchone()
+        return row if row else (0, 0)
+
+    def get_balance_between(self, start, end):
+        row = self.db.execute("SELECT SUM(revenue), SUM(count) FROM sales WHERE kind = 'day' AND key BETWEEN ? AND ?", (start, end)).fetchone()
+        return row[0] or 0, row[1] or 0
+
+    def get_balance_by_zone(self):
+        return self.db.execute("SELECT key, count, revenue FROM sales WHERE kind = 'zone'").fetchall()
+
+    async def get_archivable_orders_async(self, cutoff):
+        # La conexión principal no se comparte entre hilos: el hilo abre la suya (WAL deja leer en paralelo).
+        # El índice por día deja fuera los pedidos recientes sin leer su doc
+        marks = ",".join("?" * len(TERMINAL_STATUSES))
+        def scan():
+            db = sqlite3.connect(self.path)
+            try:
+                rows = db.execute(f"SELECT seq, status, doc FROM orders WHERE day < ? AND status IN ({marks})",
+                                  (cutoff, *TERMINAL_STATUSES))
+                return list(map(self._order, rows))
+            finally:
+                db.close()
+        return await asyncio.to_thread(scan)
+
+    # --- Modificaciones ---
+
+    def remove_orders(self, order_ids):
+        with self.db:
+            self.db.executemany("DELETE FROM orders WHERE order_id = ?", ((order_id,) for order_id in order_ids))
+
+    def add_order(self, order):
+        with self.db:
+            row = self.db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'orders'").fetchone()
+            seq = (row[0] if row else 0) + 1
+            order["seq"] = seq
+            order["order_id"] = make_order_id(seq)
+            self.db.execute("INSERT INTO orders (seq, order_id, user_id, status, doc, day) VALUES (?, ?, ?, ?, ?, ?)",
+                            (seq, order["order_id"], order["user_id"], order["status"], json.dumps(order, ensure_ascii=False),
+                             order_day(order)))
+        return order["order_id"]
+
+    def set_order_status(self, order_id, status):
+        with self.db:
+            if status == "REALIZADO":
+                order = self.get_order(order_id)
+                if order and order["status"] != "REALIZADO":
+                    day = datetime.now().strftime("%Y-%m-%d")
+                    self._add_sale(order["zone"], day, order["total"])
+                    self.db.execute("UPDATE orders SET doc = json_set(doc, '$.delivered_at', ?) WHERE order_id = ?", (day, order_id))
+            self.db.execute("UPDATE orders SET status = ? WHERE order_id = ?", (status, order_id))
+
+    def add_product(self, name, price, photo_id):
+        menu = self.get_menu()
+        with self.db:
+            # AUTOINCREMENT nunca reutiliza posiciones, así que el id corto tampoco se repite
+            row = self.db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'menu'").fetchone()
+            pos = (row[0] if row else 0) + 1
+            item = {"id": short_id(pos), "name": name, "price": price, "photo_id": photo_id, "stock": None}
+            self.db.execute("INSERT INTO menu (pos, id, name, price, photo_id) VALUES (?, ?, ?, ?, ?)",
+                            (pos, item["id"], name, price, photo_id))
+        menu.append(item)
+        self.menu_index[item["id"]] = item
+        return item
+
+    def clear_menu(self):
+        with self.db:
+            self.db.execute("DELETE FROM menu")
+        self.menu = []
+        self.menu_index = {}
+
+    def replace_menu(self, items):
+        menu = []
+        with self.db:
+            row = self.db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'menu'").fetchone()
+            pos = row[0] if row else 0
+            self.db.execute("DELETE FROM menu")
+            for item in items:
+                pos += 1
+                item = dict(item, id=item.get("id") or short_id(pos))
+                self.db.execute("INSERT INTO menu (pos, id, name, price, photo_id, stock) VALUES (?, ?, ?, ?, ?, ?)",
+                                (pos, item["id"], item["name"], item["price"], item.get("photo_id"), item.get("stock")))
+                menu.append(item)
+        self.menu = menu
+        self.menu_index = {p["id"]: p for p in menu}
+        return menu
+
+    def set_stock(self, changes):
+        self.get_menu()
+        with self.db:
+            self.db.executemany("UPDATE menu SET stock = ? WHERE id = ?", ((stock, product_id) for product_id, stock in changes.items()))
+        for product_id, stock in changes.items():
+            if product_id in self.menu_index:
+                self.menu_index[product_id]["stock"] = stock
+
+    # --- Escritura a disco (SQLite confirma cada cambio al momento) ---
+
+    def flush(self):
+        pass
+
+    async def flush_async(self):
+        pass
+
+    def compact(self):
+        wal = self.path + "-wal"
+        written = os.path.getsize(wal) if os.path.exists(wal) else 0
+        with metrics.timer("storage_seconds", op="checkpoint"):
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        metrics.inc("storage_bytes_total", written, op="checkpoint")
+
+    async def compact_async(self):
+        self.compact()
+
+def open_storage(path, backend=None):
+    if not backend:
+        backend = "sqlite" if os.path.splitext(path)[1].lower() in (".db", ".sqlite", ".sqlite3") else "json"
+    if backend == "sqlite":
+        return SqliteStorage(path)
+    return JsonStorage(path, JOURNAL_FILE if path == DATA_FILE else None)
+
+storage = open_storage(DATA_FILE, STORAGE_BACKEND)
+
+def save_data(data):
+    storage.save(data)
+    inventory.reset()
+    invalidate_menu_keyboard()
+
+async def flush_data_job(context: ContextTypes.DEFAULT_TYPE):
+    await storage.flush_async()
+
+async def compact_data_job(context: ContextTypes.DEFAULT_TYPE):
+    await storage.compact_async()
+
+# Las modificaciones que esperan (await) entre leer y escribir deben hacerse
+# dentro de `async with transaction():` para que dos handlers concurrentes no
+# se pisen los cambios.
+DATA_LOCK = asyncio.Lock()
+
+@contextlib.asynccontextmanager
+async def transaction():
+    async with DATA_LOCK:
+        yield storage
+
+def migrate_json_to_sqlite(json_path, db_path):
+    """Copia una base database.json (incluido su diario) a una base SQLite nueva"""
+    data = JsonStorage(json_path).load()
+    SqliteStorage(db_path).save(data)
+    return len(data["menu"]), len(data["orders"])
+
+# --- ARCHIVO DE PEDIDOS ---
+# Los pedidos REALIZADO/RECHAZADO de más de ARCHIVE_DAYS días salen de la base
+# activa y se guardan comprimidos en ARCHIVE_DIR, un archivo por mes
+# (orders-AAAA-MM.jsonl.gz). Así la base solo carga el menú y los pedidos
+# recientes; el historial viejo se lee únicamente cuando alguien lo pide. El
+# balance no lo necesita: los acumulados de ventas se conservan completos.
+
+ARCHIVE_DAYS = int(os.environ.get("ARCHIVE_DAYS", 30))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", f"{os.path.splitext(DATA_FILE)[0]}_archive")
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", 86400))
+
+def archive_path(month):
+    return os.path.join(ARCHIVE_DIR, f"orders-{month}.jsonl.gz")
+
+def archive_months():
+    """Meses (AAAA-MM) con pedidos archivados, del más reciente al más antiguo"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    names = (n for n in os.listdir(ARCHIVE_DIR) if n.startswith("orders-") and n.endswith(".jsonl.gz"))
+    return sorted((n[len("orders-"):-len(".jsonl.gz")] for n in names), reverse=True)
+
+def write_archive(orders):
+    by_month = {}
+    for order in orders:
+        by_month.setdefault(order_day(order)[:7], []).append(order)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for month, items in by_month.items():
+        # Cada escritura agrega un miembro gzip nuevo al final del archivo del mes
+        with open(archive_path(month), "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="ab") as f:
+                f.write("".join(json.dumps(o, ensure_ascii=False) + "\n" for o in items).encode("utf-8"))
+            raw.flush()
+            os.fsync(raw.fileno())
+
+def read_archive(month, user_id=None):
+    """Pedidos archivados de un mes (opcionalmente de un usuario), del más nuevo al más viejo"""
+    if not os.path.exists(archive_path(month)):
+        return []
+    orders = {}
+    with gzip.open(archive_path(month), "rt", encoding="utf-8") as f:
+        for line in f:
+            order = json.loads(line)
+            if user_id is None or order["user_id"] == user_id:
+                # Si un corte repitió el archivado de un pedido, vale la última copia
+                orders[order["order_id"]] = order
+    return sorted(orders.values(), key=lambda o: o["seq"], reverse=True)
+
+async def archive_old_orders():
+    """Mueve al archivo los pedidos terminados más viejos que ARCHIVE_DAYS; devuelve cuántos"""
+    cutoff = (datetime.now() - timedelta(days=ARCHIVE_DAYS)).strftime("%Y-%m-%d")
+    old = await storage.get_archivable_orders_async(cutoff)
+    if not old:
+        return 0
+    # Primero se escriben al archivo y solo después se quitan de la base activa
+    await asyncio.to_thread(write_archive, old)
+    storage.remove_orders([o["order_id"] for o in old])
+    await storage.compact_async()
+    logger.info("Archivados %s pedidos anteriores a %s", len(old), cutoff)
+    return len(old)
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    await archive_old_orders()
+
+def get_balance():
+    return storage.get_balance()
+
+def es_admin(user_id):
+    return user_id in ADMIN_IDS
+
+# --- PLANTILLAS ---
+# Todo texto que escribe un usuario (nombres, direcciones, productos, zonas)
+# pasa por md() antes de entrar en un mensaje con parse_mode="Markdown". En el
+# Markdown clásico de Telegram no se puede escapar dentro de una entidad, así
+# que md_bold() cierra y reabre la negrita alrededor de cada asterisco.
+#
+# Los textos de un pedido (aviso al admin, ficha del admin y aviso de estado al
+# cliente) se generan una vez por pedido y estado y se guardan en un LRU de
+# RENDER_CACHE_SIZE pedidos: volver a mostrar un pedido es una consulta al
+# diccionario. Los campos escapados no dependen del estado y se conservan; los
+# textos se descartan cuando el estado del pedido cambia.
+
+RENDER_CACHE_SIZE = 1000
+
+def md(text):
+    return escape_markdown(str(text), version=1)
+
+def md_bold(text):
+    return "*" + str(text).replace("*", "*\\**") + "*"
+
+def get_cart_summary(items):
+    """Texto (ya escapado) y subtotal de una lista de líneas {name, price, qty} (carrito o pedido guardado)"""
+    total = 0
+    lines = []
+    for item in items:
+        subtotal = item['price'] * item['qty']
+        total += subtotal
+        lines.append(f"{item['qty']}x {md(item['name'])} - {subtotal} CUP\n")
+    return "".join(lines), total
+
+ORDER_TEMPLATES = {
+    "ticket": ("🧾 *PRE-TICKET*\n\n👤 {name}\n📍 {zone}\n🏠 {address}\n📞 {phone}\n\n"
+               "{items}\n----------------\n🛍️ Subtotal: {subtotal} CUP\n🛵 Mensajería: {delivery} CUP\n💰 *TOTAL: {total} CUP*"),
+    "admin_notice": ("🆕 *PEDIDO #{order_id}*\n\n👤 {name}\n📍 {zone}\n🏠 {address}\n📞 {phone}\n\n"
+                     "{items}\n----------------\n🛵 Mensajería: {delivery} CUP\n💰 *TOTAL: {total} CUP*"),
+    "admin_card": ("📦 *Pedido #{order_id}*\nEstado: {status_emoji} {status}\n\n👤 {name}\n📍 {zone}\n🏠 {address}\n📞 {phone}\n\n"
+                   "{items}\n----------------\n💰 *TOTAL: {total} CUP*"),
+    "customer_status": "{status_message}",
+}
+
+CUSTOMER_STATUS_MESSAGES = {
+    "ACEPTADO": "✅ *Pedido #{order_id} ACEPTADO* en DolceZZa.",
+    "RECHAZADO": "❌ *Pedido #{order_id} RECHAZADO*.",
+    "REALIZADO": "🏁 *Pedido #{order_id} ENTREGADO*.\n¡Gracias por comprar en DolceZZa!",
+}
+
+def order_fields(order):
+    """Campos escapados de un pedido (o borrador de pedido) que no dependen de su estado"""
+    items_text, _ = get_cart_summary(order["items"])
+    return {
+        "order_id": md(order["order_id"]), "name": md(order["user_name"]), "zone": md(order["zone"]),
+        "address": md(order["address"]), "phone": md(order["user_phone"]), "items": items_text,
+        "subtotal": order["subtotal"], "delivery": order["delivery_cost"], "total": order["total"],
+    }
+
+def _status_fields(fields, status):
+    message = CUSTOMER_STATUS_MESSAGES.get(status, "")
+    return dict(fields, status=status, status_emoji="⏳" if status == "PENDIENTE" else "✅", status_message=message.format(order_id=fields["order_id"]))
+
+_rendered = OrderedDict()   # order_id -> {"status", "fields", plantilla: texto}
+
+def render_order(template, order):
+    """Texto de la plantilla para el pedido, desde la caché si ya se generó con este estado"""
+    if not order.get("order_id"):
+        # Borrador (pre-ticket): todavía no tiene id con el que guardarlo
+        return ORDER_TEMPLATES[template].format_map(_status_fields(order_fields(dict(order, order_id="")), order["status"]))
+    order_id = order["order_id"]
+    entry = _rendered.get(order_id)
+    if entry is None:
+        entry = _rendered[order_id] = {"status": None, "fields": order_fields(order)}
+        if len(_rendered) > RENDER_CACHE_SIZE:
+            _rendered.popitem(last=False)
+    else:
+        _rendered.move_to_end(order_id)
+    if entry["status"] != order["status"]:
+        base = entry["fields"]
+        entry.clear()
+        entry.update(status=order["status"], fields=base, values=_status_fields(base, order["status"]))
+    text = entry.get(template)
+    if text is None:
+        text = entry[template] = ORDER_TEMPLATES[template].format_map(entry["values"])
+    return text
+
+def invalidate_order_render(order_id):
+    _rendered.pop(order_id, None)
+
+# --- CARRITO ---
+# El carrito es un dict {id de producto: cantidad}: nombre y precio se leen del
+# menú al mostrarlo, así cada sesión guarda solo ids y cantidades y se
+# serializa tal cual en SqlitePersistence. Las líneas, el texto y el teclado
+# del carrito se calculan una vez y se reutilizan hasta que el carrito o el
+# menú cambien.
+
+class Cart(dict):
+    __slots__ = ("_view",)
+
+    def __init__(self, items=()):
+        super().__init__(items)
+        self._view = None
+
+    @classmethod
+    def from_saved(cls, saved):
+        if isinstance(saved, list):
+            # Sesiones anteriores: lista de {"id", "name", "price", "qty"}
+            return cls((item["id"], item["qty"]) for item in saved)
+        return cls(saved or {})
+
+    def add(self, product_id, qty=1):
+        """Suma (o resta) unidades; con 0 o menos el producto sale del carrito. Devuelve la cantidad final"""
+        qty = self.get(product_id, 0) + qty
+        if qty > 0:
+            self[product_id] = qty
+        else:
+            self.pop(product_id, None)
+        self._view = None
+        return max(qty, 0)
+
+    def clear(self):
+        super().clear()
+        self._view = None
+
+    @property
+    def count(self):
+        """Unidades que se ven en el carrito (sin los productos retirados del menú)"""
+        return sum(line["qty"] for line in self._render()[1])
+
+    def _render(self):
+        if self._view is None or self._view[0] != menu_version:
+            lines = []
+            for product_id, qty in self.items():
+                product = storage.get_product(product_id)
+                if product:   # los productos retirados del menú no se muestran ni se cobran
+                    lines.append({"id": product_id, "name": product["name"], "price": product["price"], "qty": qty})
+            text, subtotal = get_cart_summary(lines)
+            self._view = (menu_version, lines, text, subtotal, None)
+        return self._view
+
+    def lines(self):
+        """Líneas con nombre y precio actuales, como se guardan en el pedido"""
+        return [dict(line) for line in self._render()[1]]
+
+    def summary(self):
+        _, _, text, subtotal, _ = self._render()
+        return text, subtotal
+
+    def keyboard(self):
+        """Teclado del carrito con botones −/+ por producto"""
+        view = self._render()
+        if view[4] is None:
+            keyboard = []
+            for line in view[1]:
+                keyboard.append([
+                    InlineKeyboardButton("➖", callback_data=f"c-{line['id']}"),
+                    InlineKeyboardButton(f"{line['qty']}x {line['name']}", callback_data=f"prod_{line['id']}"),
+                    InlineKeyboardButton("➕", callback_data=f"c+{line['id']}"),
+                ])
+            keyboard += [
+                [InlineKeyboardButton("🚀 Realizar Pedido", callback_data="start_checkout")],
+                [InlineKeyboardButton("🗑️ Vaciar Carrito", callback_data="clear_cart")],
+                [InlineKeyboardButton("🔙 Volver", callback_data="back_main")]
+            ]
+            self._view = view[:4] + (InlineKeyboardMarkup(keyboard),)
+        return self._view[4]
+
+def get_cart(user_data):
+    cart = user_data.get('cart')
+    if not isinstance(cart, Cart):
+        cart = user_data['cart'] = Cart.from_saved(cart)
+    return cart
+
+# --- EXISTENCIAS ---
+# Un producto con "stock" tiene unidades contadas; sin él (None) no tiene
+# límite. Los pedidos PENDIENTE y ACEPTADO apartan sus unidades en una tabla en
+# memoria (se rehace desde los pedidos activos al arrancar), así que lo
+# disponible es stock - apartado: una resta por línea del carrito, sin tocar el
+# disco. Al entregar el pedido se descuenta del stock guardado y al rechazarlo
+# se libera. Con RESERVATION_TIMEOUT (desactivado por defecto) un pedido que
+# aparta unidades contadas y sigue PENDIENTE ese tiempo se rechaza solo y las
+# devuelve; los pedidos sin productos con stock nunca caducan. El
+# teclado del menú oculta los agotados y solo se reconstruye cuando un producto
+# se agota o vuelve a haber.
+
+RESERVATION_TIMEOUT = float(os.environ.get("RESERVATION_TIMEOUT", 0))   # 0 = sin caducidad
+RESERVATION_CHECK_INTERVAL = 60
+
+def order_quantities(items):
+    """Unidades por producto de unas líneas de carrito o pedido"""
+    quantities = {}
+    for item in items:
+        if item.get("id"):
+            quantities[item["id"]] = quantities.get(item["id"], 0) + item["qty"]
+    return quantities
+
+def order_timestamp(order):
+    try:
+        return datetime.strptime(order["date"], "%d/%m/%Y %H:%M").timestamp()
+    except (KeyError, ValueError):
+        return time.time()
+
+class Inventory:
+    def __init__(self):
+        self.reserved = None   # id de producto -> unidades apartadas
+        self.holds = {}        # order_id -> [{id: unidades}, caduca (None si ya no caduca)]
+
+    def load(self):
+        if self.reserved is None:
+            self.reserved = {}
+            after = 0
+            while True:
+                page = storage.get_active_orders(500, after)
+                if not page:
+                    break
+                for order in page:
+                    quantities = order_quantities(order["items"])
+                    expires = self._expiry(quantities, order_timestamp(order)) if order["status"] == "PENDIENTE" else None
+                    self._hold(order["order_id"], quantities, expires)
+                after = page[-1]["seq"]
+        return self.reserved
+
+    def reset(self):
+        """Olvida la tabla (se rehace en la próxima consulta), p. ej. tras reemplazar la base"""
+        self.reserved = None
+        self.holds.clear()
+
+    def available(self, product_id):
+        """Unidades que aún se pueden vender, o None si el producto no tiene límite"""
+        product = storage.get_product(product_id)
+        if not product:
+            return 0
+        if product.get("stock") is None:
+            return None
+        return max(product["stock"] - self.load().get(product_id, 0), 0)
+
+    def can_sell(self, product_id, qty):
+        available = self.available(product_id)
+        return available is None or available >= qty
+
+    def shortages(self, quantities):
+        """Productos de `quantities` sin unidades suficientes: lista de (id, disponibles)"""
+        missing = []
+        for product_id, qty in quantities.items():
+            available = self.available(product_id)
+            if available is not None and available < qty:
+                missing.append((product_id, available))
+        return missing
+
+    def _expiry(self, quantities, since):
+        """Momento en que caduca la reserva, o None si no aparta ningún producto con stock"""
+        if RESERVATION_TIMEOUT <= 0:
+            return None
+        if not any(storage.get_product(pid) and storage.get_product(pid).get("stock") is not None for pid in quantities):
+            return None
+        return since + RESERVATION_TIMEOUT
+
+    def _hold(self, order_id, quantities, expires):
+        for product_id, qty in quantities.items():
+            self.reserved[product_id] = self.reserved.get(product_id, 0) + qty
+        self.holds[order_id] = [quantities, expires]
+
+    def _unhold(self, order_id):
+        quantities = self.holds.pop(order_id, [{}])[0]
+        for product_id, qty in quantities.items():
+            left = self.reserved.get(product_id, 0) - qty
+            if left > 0:
+                self.reserved[product_id] = left
+            else:
+                self.reserved.pop(product_id, None)
+        return quantities
+
+    def _sold_out(self, product_ids):
+        return [self.available(pid) == 0 for pid in product_ids]
+
+    def reserve(self, order_id, quantities):
+        """Aparta las unidades de un pedido nuevo (comprobar antes con shortages)"""
+        self.load()
+        before = self._sold_out(quantities)
+        self._hold(order_id, quantities, self._expiry(quantities, time.time()))
+        if self._sold_out(quantities) != before:
+            refresh_menu_keyboard()
+
+    def keep(self, order_id):
+        """El pedido fue aceptado: su reserva ya no caduca"""
+        self.load()
+        if order_id in self.holds:
+            self.holds[order_id][1] = None
+
+    def release(self, order_id):
+        """Devuelve al disponible las unidades de un pedido rechazado o caducado"""
+        self.load()
+        quantities = self.holds.get(order_id, [{}])[0]
+        before = self._sold_out(quantities)
+        self._unhold(order_id)
+        if self._sold_out(quantities) != before:
+            refresh_menu_keyboard()
+
+    def consume(self, order_id):
+        """Pedido entregado: descuenta sus unidades del stock guardado"""
+        self.load()
+        quantities = self._unhold(order_id)
+        changes = {}
+        for product_id, qty in quantities.items():
+            product = storage.get_product(product_id)
+            if product and product.get("stock") is not None:
+                changes[product_id] = max(product["stock"] - qty, 0)
+        if changes:
+            # Lo disponible no cambia: las unidades pasan de apartadas a vendidas
+            storage.set_stock(changes)
+
+    def set_stock(self, product_id, stock):
+        self.load()
+        before = self._sold_out([product_id])
+        storage.set_stock({product_id: stock})
+        if self._sold_out([product_id]) != before:
+            refresh_menu_keyboard()
+
+    def expired(self, now=None):
+        """order_id de las reservas PENDIENTE que ya caducaron"""
+        self.load()
+        now = now or time.time()
+        return [order_id for order_id, (_, expires) in self.holds.items() if expires is not None and expires <= now]
+
+inventory = Inventory()
+
+def shortage_text(missing):
+    """Aviso al cliente con los productos que no alcanzan (texto plano)"""
+    lines = []
+    for product_id, available in missing:
+        product = storage.get_product(product_id)
+        name = product["name"] if product else "Producto retirado"
+        lines.append(f"• {name}: {'agotado' if not available else f'solo quedan {available}'}")
+    return "😔 No hay suficientes existencias:\n" + "\n".join(lines) + "\n\nAjusta tu carrito y vuelve a finalizar."
+
+async def reservations_job(context: ContextTypes.DEFAULT_TYPE):
+    """Rechaza los pedidos que siguen PENDIENTE con la reserva caducada y libera sus unidades"""
+    for order_id in inventory.expired():
+        async with transaction():
+            order = storage.get_order(order_id)
+            if order and order["status"] == "ACEPTADO":
+                inventory.keep(order_id)
+                continue
+            if not order or order["status"] != "PENDIENTE":
+                inventory.release(order_id)
+                continue
+            storage.set_order_status(order_id, "RECHAZADO")
+            invalidate_order_render(order_id)
+            inventory.release(order_id)
+        text = render_order("customer_status", dict(order, status="RECHAZADO")) + "\n⏰ No se confirmó a tiempo."
+        queue_notification(context, f"{order_id}:RECHAZADO", [order["user_id"]], text)
+
+# --- TECLADOS PRECALCULADOS ---
+# Los teclados fijos se construyen una sola vez al importar. El del menú del
+# día se reconstruye solo cuando el menú cambia o un producto se agota o vuelve
+# a haber (los agotados no se muestran) y el menú principal solo varía
+# en el contador del carrito, así que se guarda uno por cada cantidad.
+
+# Con GALLERY_MODE el menú ofrece sus fotos en álbumes y la ficha de producto
+# es un único mensaje con foto que se edita en su sitio al navegar
+GALLERY_MODE = os.getenv("GALLERY_MODE", "0").lower() in ("1", "true", "yes")
+
+ADMIN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Agregar Producto", callback_data="admin_add_start")],
+    [InlineKeyboardButton("📦 Gestionar Pedidos", callback_data="admin_orders")],
+    [InlineKeyboardButton("📊 Ver Balance", callback_data="admin_balance")],
+    [InlineKeyboardButton("📥 Importar Menú", callback_data="admin_import"), InlineKeyboardButton("📤 Exportar Menú", callback_data="admin_export")],
+    [InlineKeyboardButton("🗑️ Borrar Menú", callback_data="admin_clear")]
+])
+
+BALANCE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📅 Hoy", callback_data="bal_1"), InlineKeyboardButton("📅 7 días", callback_data="bal_7")],
+    [InlineKeyboardButton("📅 Este mes", callback_data="bal_month"), InlineKeyboardButton("📍 Por Zona", callback_data="bal_zone")],
+    [InlineKeyboardButton("🔙 Menú Admin", callback_data="start")]
+])
+
+BACK_MAIN_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver", callback_data="back_main")]])
+
+@functools.lru_cache(maxsize=None)
+def main_menu_keyboard(cart_count):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"🍬 Ver Menú", callback_data="view_menu")],
+        [InlineKeyboardButton(f"🛒 Mi Carrito ({cart_count})", callback_data="view_cart")],
+        [InlineKeyboardButton(f"📦 Mis Pedidos", callback_data="my_orders")],
+        [InlineKeyboardButton(f"📍 Cambiar Zona", callback_data="change_zone")]
+    ])
+
+_menu_keyboard = None
+
+def get_menu_keyboard():
+    """Teclado del menú del día, o None si no hay productos disponibles"""
+    global _menu_keyboard
+    if _menu_keyboard is None:
+        menu = [item for item in storage.get_menu() if inventory.available(item["id"]) != 0]
+        if not menu:
+            return None
+        keyboard = []
+        for item in menu:
+            keyboard.append([InlineKeyboardButton(f"🍩 {item['name']} - {item['price']} CUP", callback_data=f"prod_{item['id']}")])
+        if GALLERY_MODE and any(product_photo(item) for item in menu):
+            keyboard.append([InlineKeyboardButton("📸 Ver Fotos del Menú", callback_data="view_gallery")])
+        keyboard.append([InlineKeyboardButton("🔙 Volver", callback_data="back_main")])
+        _menu_keyboard = InlineKeyboardMarkup(keyboard)
+    return _menu_keyboard
+
+# Cambia con cada edición del menú; los álbumes enviados se comparan con él
+menu_version = 0
+
+def invalidate_menu_keyboard():
+    global _menu_keyboard, menu_version
+    _menu_keyboard = None
+    menu_version += 1
+
+def refresh_menu_keyboard():
+    """Solo cambió qué productos están agotados: se rehace el teclado sin invalidar carritos ni álbumes"""
+    global _menu_keyboard
+    _menu_keyboard = None
+
+# --- GALERÍA ---
+# Telegram devuelve un file_id propio al enviar cada foto: se guarda por
+# producto y se reutiliza. Si una foto es rechazada se anota None y el
+# producto se muestra sin foto en vez de fallar en cada toque.
+
+ALBUM_SIZE = 10  # máximo de fotos por álbum en la Bot API
+
+PHOTO_CACHE = {}
+
+def product_photo(product):
+    """file_id con el que enviar la foto del producto, o None"""
+    if product["id"] in PHOTO_CACHE:
+        return PHOTO_CACHE[product["id"]]
+    return product.get("photo_id")
+
+def remember_photo(product, message):
+    if message.photo:
+        PHOTO_CACHE[product["id"]] = message.photo[-1].file_id
+
+def is_bad_photo(error):
+    """El BadRequest se debe a un file_id inválido"""
+    return "file" in error.message.lower()
+
+def is_not_modified(error):
+    """El BadRequest se debe a editar un mensaje con el mismo contenido"""
+    return "not modified" in error.message.lower()
+
+def product_caption(product):
+    return f"{md_bold(product['name'])}\n💰 Precio: {product['price']} CUP"
+
+def product_keyboard(prod_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("➕ Agregar al Carrito", callback_data=f"addcart_{prod_id}")],
+        [InlineKeyboardButton("🔙 Volver al Menú", callback_data="view_menu")]
+    ])
+
+async def send_album(bot, chat_id, products):
+    """Envía hasta ALBUM_SIZE fotos en un álbum; devuelve los mensajes enviados"""
+    media = [InputMediaPhoto(product_photo(p), caption=product_caption(p), parse_mode="Markdown") for p in products]
+    try:
+        if len(media) == 1:
+            # sendMediaGroup exige al menos dos elementos
+            messages = [await bot.send_photo(chat_id, media[0].media, caption=media[0].caption, parse_mode="Markdown")]
+        else:
+            messages = await bot.send_media_group(chat_id, media)
+    except BadRequest as e:
+        if not is_bad_photo(e): raise
+        if len(products) == 1:
+            PHOTO_CACHE[products[0]["id"]] = None
+            return []
+        # Alguna foto del álbum no es válida: se envían por separado para aislarla
+        messages = []
+        for product in products:
+            messages += await send_album(bot, chat_id, [product])
+        return messages
+    for product, message in zip(products, messages):
+        remember_photo(product, message)
+    return messages
+
+async def show_in_viewer(context, query, product, markup):
+    """Muestra el producto editando el mensaje con foto del chat. Devuelve False si hay que enviar uno nuevo"""
+    viewer_id = query.message.message_id if query.message.photo else context.chat_data.get("viewer")
+    if not viewer_id:
+        return False
+    media = InputMediaPhoto(product_photo(product), caption=product_caption(product), parse_mode="Markdown")
+    try:
+        message = await context.bot.edit_message_media(media, chat_id=query.message.chat_id, message_id=viewer_id, reply_markup=markup)
+    except BadRequest as e:
+        if is_not_modified(e):
+            return True
+        if is_bad_photo(e):
+            PHOTO_CACHE[product["id"]] = None
+        # El mensaje ya no existe o no se puede editar
+        context.chat_data.pop("viewer", None)
+        return False
+    context.chat_data["viewer"] = viewer_id
+    if message is not True:
+        remember_photo(product, message)
+    return True
+
+# --- NOTIFICACIONES ---
+# Los avisos a admins y clientes se envían en paralelo con un máximo de
+# NOTIFY_CONCURRENCY envíos simultáneos. Si Telegram pide esperar
+# (RetryAfter) se pausan todos los envíos ese tiempo; los errores de red se
+# reintentan hasta NOTIFY_RETRIES veces antes de devolver el error.
+
+NOTIFY_CONCURRENCY = int(os.environ.get("NOTIFY_CONCURRENCY", 8))
+NOTIFY_RETRIES = int(os.environ.get("NOTIFY_RETRIES", 3))
+
+_notify_slots = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+_notify_paused_until = 0.0
+
+async def send_notification(bot, chat_id, text, reply_markup=None, parse_mode="Markdown"):
+    """Envía un mensaje con reintentos; devuelve None si llegó o el último error"""
+    global _notify_paused_until
+    loop = asyncio.get_running_loop()
+    error = None
+    for attempt in range(NOTIFY_RETRIES):
+        delay = _notify_paused_until - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            async with _notify_slots:
+                await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+            return None
+        except RetryAfter as e:
+            error = e
+            _notify_paused_until = max(_notify_paused_until, loop.time() + e.retry_after)
+        except (BadRequest, Forbidden) as e:
+            # Chat inexistente, bot bloqueado o texto inválido: reintentar no sirve
+            return e
+        except NetworkError as e:
+            error = e
+            await asyncio.sleep(2 ** attempt)
+    return error
+
+# --- MENÚ EN BLOQUE ---
+# El admin puede subir el menú entero como CSV o JSON. El archivo se valida
+# completo antes de tocar nada y se aplica con un solo replace_menu.
+
+MENU_FILE_MAX_BYTES = 1024 * 1024
+MENU_NAME_MAX = 64
+
+# Encabezados aceptados para cada campo (se comparan en minúsculas)
+MENU_COLUMNS = {
+    "id": ("id",),
+    "name": ("nombre", "name", "producto"),
+    "price": ("precio", "price"),
+    "photo_id": ("foto", "photo_id", "photo"),
+    "stock": ("existencias", "stock"),
 }
 
-# ESTADOS DE CONVERSACIÓN
-ADD_NAME, ADD_PRICE, ADD_PHOTO = range(3)
-CHK_NAME, CHK_ADDRESS, CHK_PHONE = range(3)
+def _menu_row(raw):
+    """Normaliza una fila del archivo a las claves id/name/price/photo_id/stock"""
+    lowered = {str(k).strip().lower(): v for k, v in raw.items() if k is not None}
+    row = {}
+    for field, names in MENU_COLUMNS.items():
+        for name in names:
+            if name in lowered:
+                row[field] = lowered[name]
+                break
+    return row
+
+def parse_menu_file(content, filename):
+    """Lee un menú en CSV o JSON; lanza ValueError con todos los errores encontrados"""
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("El archivo debe estar en UTF-8.")
+    
+    if filename.lower().endswith(".json") or text.lstrip().startswith(("[", "{")):
+        try:
+            raw_rows = json.loads(text)
+        except ValueError as e:
+            raise ValueError(f"JSON inválido: {e}")
+        if isinstance(raw_rows, dict):
+            raw_rows = raw_rows.get("menu")
+        if not isinstance(raw_rows, list) or not all(isinstance(r, dict) for r in raw_rows):
+            raise ValueError("El JSON debe ser una lista de productos o {\"menu\": [...]}.")
+        first_line = 1
+    else:
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        raw_rows = list(csv.DictReader(io.StringIO(text), dialect=dialect))
+        first_line = 2  # la línea 1 es el encabezado
+    
+    rows, errors, seen = [], [], set()
+    for n, raw in enumerate(raw_rows, start=first_line):
+        row = _menu_row(raw)
+        name = str(row.get("name") or "").strip()
+        price = row.get("price")
+        try:
+            price = int(str(price).strip())
+        except (TypeError, ValueError):
+            price = None
+        if not name:
+            errors.append(f"Fila {n}: falta el nombre.")
+        elif len(name) > MENU_NAME_MAX:
+            errors.append(f"Fila {n}: nombre de más de {MENU_NAME_MAX} caracteres.")
+        elif name.lower() in seen:
+            errors.append(f"Fila {n}: '{name}' está repetido.")
+        if price is None or price <= 0:
+            errors.append(f"Fila {n}: precio inválido.")
+        seen.add(name.lower())
+        parsed = {
+            "id": str(row.get("id") or "").strip(),
+            "name": name,
+            "price": price,
+            "photo_id": str(row.get("photo_id") or "").strip() or None,
+        }
+        if "stock" in row:
+            # Columna presente: vacía = sin límite
+            stock = str(row["stock"] if row["stock"] is not None else "").strip()
+            if not stock:
+                parsed["stock"] = None
+            elif stock.isdigit():
+                parsed["stock"] = int(stock)
+            else:
+                errors.append(f"Fila {n}: existencias inválidas.")
+        rows.append(parsed)
+    if not rows and not errors:
+        errors.append("El archivo no tiene productos.")
+    if errors:
+        raise ValueError("\n".join(errors[:10]) + (f"\n... y {len(errors) - 10} errores más." if len(errors) > 10 else ""))
+    return rows
+
+def build_imported_menu(current, rows, merge):
+    """Menú resultante de importar `rows` sobre `current`.
+
+    Cada fila actualiza el producto con su mismo id, o si no con su mismo
+    nombre, conservando el id (y la foto si la fila no trae otra; las
+    existencias si el archivo no tiene esa columna). Con merge
+    los productos que no aparecen se mantienen; sin merge se descartan.
+    """
+    by_id = {p["id"]: p for p in current}
+    by_name = {p["name"].lower(): p for p in current}
+    updated, new_items = {}, []
+    for row in rows:
+        match = by_id.get(row["id"]) or by_name.get(row["name"].lower())
+        if match and match["id"] not in updated:
+            updated[match["id"]] = dict(match, name=row["name"], price=row["price"], photo_id=row["photo_id"] or match.get("photo_id"),
+                                        stock=row.get("stock", match.get("stock")))
+            if not merge:
+                new_items.append(updated[match["id"]])
+        else:
+            # Los ids desconocidos se ignoran para no chocar con los que se asignen después
+            new_items.append({"name": row["name"], "price": row["price"], "photo_id": row["photo_id"], "stock": row.get("stock")})
+    if not merge:
+        return new_items
+    return [updated.get(p["id"], p) for p in current] + new_items
+
+def export_menu(menu, fmt):
+    """Menú como archivo CSV o JSON (bytes), en el mismo formato que acepta la importación"""
+    if fmt == "json":
+        return json.dumps([{"id": p["id"], "nombre": p["name"], "precio": p["price"], "foto": p.get("photo_id"), "existencias": p.get("stock")} for p in menu],
+                          ensure_ascii=False, indent=2).encode("utf-8")
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["id", "nombre", "precio", "foto", "existencias"])
+    for p in menu:
+        writer.writerow([p["id"], p["name"], p["price"], p.get("photo_id") or "", "" if p.get("stock") is None else p["stock"]])
+    return out.getvalue().encode("utf-8-sig")
+
+# --- BANDEJA DE SALIDA ---
+# Cada aviso se guarda primero en OUTBOX_FILE (junto a DATA_FILE) y un worker
+# lo entrega en segundo plano; así los handlers responden al momento y un
+# redespliegue a mitad de envío no pierde mensajes. Los fallos se reintentan
+# con espera exponencial hasta OUTBOX_MAX_ATTEMPTS intentos. Cada mensaje
+# lleva una clave (pedido:estado:chat) para no enviar dos veces el mismo aviso.
+
+OUTBOX_FILE = os.environ.get("OUTBOX_FILE", f"{DATA_FILE}.outbox")
+OUTBOX_INTERVAL = float(os.environ.get("OUTBOX_INTERVAL", 2))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_DELIVERED_KEEP = 1000
+
+class Outbox:
+    def __init__(self, path):
+        self.path = path
+        self.pending = {}      # clave -> mensaje por entregar
+        self.delivered = []    # últimas claves entregadas (para descartar duplicados)
+        self.in_flight = set()
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    saved = json.load(f)
+                self.pending = saved["pending"]
+                self.delivered = saved["delivered"]
+            except (ValueError, KeyError):
+                logger.error("Bandeja de salida ilegible, se empieza vacía: %s", path)
+        self._delivered_set = set(self.delivered)
+
+    def save(self):
+        write_atomic(self.path, json.dumps({"pending": self.pending, "delivered": self.delivered}, ensure_ascii=False))
+
+    def add(self, key, chat_id, text, reply_markup=None, parse_mode="Markdown", report_chat_id=None, report_text=None):
+        """Encola un aviso en memoria (se guarda con save()); devuelve False si esa clave ya estaba encolada o entregada"""
+        if key in self.pending or key in self._delivered_set:
+            return False
+        self.pending[key] = {
+            "chat_id": chat_id, "text": text, "parse_mode": parse_mode,
+            "reply_markup": reply_markup.to_dict() if reply_markup else None,
+            "report_chat_id": report_chat_id, "report_text": report_text,
+            "attempts": 0, "next_try": 0,
+        }
+        return True
+
+    def _mark_delivered(self, key):
+        self.delivered.append(key)
+        self._delivered_set.add(key)
+        if len(self.delivered) > OUTBOX_DELIVERED_KEEP:
+            self._delivered_set.discard(self.delivered.pop(0))
+
+    async def _deliver(self, bot, key):
+        msg = self.pending[key]
+        markup = InlineKeyboardMarkup.de_json(msg["reply_markup"], bot) if msg["reply_markup"] else None
+        error = await send_notification(bot, msg["chat_id"], msg["text"], markup, msg["parse_mode"])
+        if error is None:
+            del self.pending[key]
+            self._mark_delivered(key)
+            return
+        msg["attempts"] += 1
+        if isinstance(error, (BadRequest, Forbidden)) or msg["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            logger.error("Aviso %s descartado tras %s intentos: %s", key, msg["attempts"], error)
+            del self.pending[key]
+            if msg["report_chat_id"]:
+                self.add(f"{key}:report", msg["report_chat_id"], msg["report_text"], parse_mode=None)
+        else:
+            msg["next_try"] = time.time() + min(2 ** msg["attempts"], 600)
+            logger.warning("Aviso %s falló (intento %s), se reintenta: %s", key, msg["attempts"], error)
+
+    async def drain(self, bot):
+        """Entrega en paralelo todos los avisos que ya toca enviar"""
+        now = time.time()
+        keys = [k for k, m in self.pending.items() if m["next_try"] <= now and k not in self.in_flight]
+        if not keys:
+            return
+        self.in_flight.update(keys)
+        try:
+            await asyncio.gather(*(self._deliver(bot, k) for k in keys))
+        finally:
+            self.in_flight.difference_update(keys)
+            self.save()
+
+outbox = Outbox(OUTBOX_FILE)
 
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+def queue_notification(context, key, chat_ids, text, reply_markup=None, report_chat_id=None, report_text=None, parse_mode="Markdown"):
+    """Guarda el aviso para cada chat (una sola escritura) y despierta al worker sin esperar el envío"""
+    added = False
+    for chat_id in chat_ids:
+        added |= outbox.add(f"{key}:{chat_id}", chat_id, text, reply_markup, parse_mode, report_chat_id=report_chat_id, report_text=report_text)
+    if added:
+        outbox.save()
+        context.application.create_task(outbox.drain(context.bot))
 
-# --- BASE DE DATOS ---
+async def outbox_job(context: ContextTypes.DEFAULT_TYPE):
+    await outbox.drain(context.bot)
 
-def load_data():
-    if not os.path.exists(DATA_FILE):
-        return {"menu": [], "orders": []}
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except:
-        return {"menu": [], "orders": []}
+# --- REPORTES DIARIOS ---
+# Cada día a las REPORT_TIME (hora local) se genera el reporte del día anterior:
+# una sola pasada sobre los pedidos de ese día, del más nuevo hacia atrás, que
+# se detiene al llegar al día previo. Solo se acumulan contadores por estado,
+# zona y producto; el detalle de cada pedido se escribe al CSV sobre la marcha.
+# Cada REPORT_YIELD_EVERY pedidos se cede el bucle para no frenar a los
+# handlers. Los archivos quedan en REPORT_DIR/AAAA-MM-DD/ y el resumen llega a
+# los ADMIN_IDS por la bandeja de salida. /reporte [AAAA-MM-DD] lo genera a
+# demanda en segundo plano.
 
-def save_data(data):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+REPORT_TIME = os.environ.get("REPORT_TIME", "00:05")   # vacío = sin reporte automático
+REPORT_DIR = os.environ.get("REPORT_DIR", f"{os.path.splitext(DATA_FILE)[0]}_reports")
+REPORT_TOP_PRODUCTS = 5
+REPORT_YIELD_EVERY = 1000
 
-def get_balance():
-    data = load_data()
-    total_sales = 0
-    delivered_count = 0
-    for order in data["orders"]:
-        if order["status"] == "REALIZADO":
-            total_sales += order["total"]
-            delivered_count += 1
-    return total_sales, delivered_count
+REPORT_ORDER_COLUMNS = ["order_id", "hora", "zona", "estado", "unidades", "subtotal", "mensajeria", "total"]
 
-def es_admin(user_id):
-    return user_id in ADMIN_IDS
+def _write_csv(path, header, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
 
-def get_cart_summary(cart):
-    total = 0
-    text = ""
-    for item in cart:
-        subtotal = item['price'] * item['qty']
-        total += subtotal
-        text += f"{item['qty']}x {item['name']} - {subtotal} CUP\n"
-    return text, total
+async def build_daily_report(day):
+    """Calcula el reporte de los pedidos creados el día `day` (AAAA-MM-DD) y escribe sus CSV"""
+    folder = os.path.join(REPORT_DIR, day)
+    os.makedirs(folder, exist_ok=True)
+    by_status = dict.fromkeys(ACTIVE_STATUSES + TERMINAL_STATUSES, 0)
+    by_zone = {}       # zona -> [pedidos, entregados, recaudado]
+    products = {}      # nombre -> [unidades, importe] de los pedidos no rechazados
+    revenue = delivery_revenue = 0
+    
+    orders_path = os.path.join(folder, "pedidos.csv")
+    with open(orders_path + ".tmp", "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(REPORT_ORDER_COLUMNS)
+        for n, order in enumerate(storage.iter_orders_desc(), 1):
+            if n % REPORT_YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+            created = order_day(order)
+            if created > day:
+                continue
+            if created < day:
+                break
+            status = order["status"]
+            by_status[status] = by_status.get(status, 0) + 1
+            zone = by_zone.setdefault(order["zone"], [0, 0, 0])
+            zone[0] += 1
+            if status == "REALIZADO":
+                zone[1] += 1
+                zone[2] += order["total"]
+                revenue += order["total"]
+                delivery_revenue += order["delivery_cost"]
+            if status != "RECHAZADO":
+                for item in order["items"]:
+                    row = products.setdefault(item["name"], [0, 0])
+                    row[0] += item["qty"]
+                    row[1] += item["qty"] * item["price"]
+            writer.writerow([order["order_id"], order["date"][-5:], order["zone"], status,
+                             sum(item["qty"] for item in order["items"]), order["subtotal"], order["delivery_cost"], order["total"]])
+    os.replace(orders_path + ".tmp", orders_path)
+    
+    top = sorted(products.items(), key=lambda r: r[1][0], reverse=True)
+    await asyncio.to_thread(_write_csv, os.path.join(folder, "zonas.csv"), ["zona", "pedidos", "entregados", "recaudado"],
+                            [(zone, *row) for zone, row in sorted(by_zone.items())])
+    await asyncio.to_thread(_write_csv, os.path.join(folder, "productos.csv"), ["producto", "unidades", "importe"],
+                            [(name, *row) for name, row in top])
+    
+    delivered = by_status["REALIZADO"]
+    decided = delivered + by_status["ACEPTADO"] + by_status["RECHAZADO"]
+    return {
+        "day": day, "orders": sum(by_status.values()), "by_status": by_status,
+        "accept_rate": (decided - by_status["RECHAZADO"]) / decided if decided else 0.0,
+        "reject_rate": by_status["RECHAZADO"] / decided if decided else 0.0,
+        "revenue": revenue, "delivery_revenue": delivery_revenue,
+        "avg_ticket": revenue // delivered if delivered else 0,
+        "by_zone": by_zone, "top_products": top[:REPORT_TOP_PRODUCTS], "folder": folder,
+    }
+
+def format_report(report):
+    """Resumen en texto plano (los nombres de productos no pasan por Markdown)"""
+    st = report["by_status"]
+    lines = [
+        f"📊 Reporte del {report['day']}",
+        "",
+        f"🧾 Pedidos: {report['orders']} (🏁 {st['REALIZADO']} entregados, ❌ {st['RECHAZADO']} rechazados, "
+        f"⏳ {st['PENDIENTE'] + st['ACEPTADO']} sin terminar)",
+        f"👍 Aceptación: {report['accept_rate']:.0%} · 👎 Rechazo: {report['reject_rate']:.0%}",
+        f"💰 Recaudado: {report['revenue']} CUP · 🛵 Mensajería: {report['delivery_revenue']} CUP",
+        f"🎟️ Ticket promedio: {report['avg_ticket']} CUP",
+    ]
+    if report["by_zone"]:
+        lines += ["", "📍 Por zona:"]
+        for zone, (orders, delivered, total) in sorted(report["by_zone"].items(), key=lambda r: r[1][2], reverse=True):
+            lines.append(f"  {zone}: {orders} pedidos, {delivered} entregados, {total} CUP")
+    if report["top_products"]:
+        lines += ["", "🍩 Más pedidos:"]
+        for i, (name, (qty, _)) in enumerate(report["top_products"], 1):
+            lines.append(f"  {i}. {name} × {qty}")
+    return "\n".join(lines)
+
+async def report_job(context: ContextTypes.DEFAULT_TYPE):
+    day = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    report = await build_daily_report(day)
+    logger.info("Reporte del %s: %s pedidos en %s", day, report["orders"], report["folder"])
+    if ADMIN_IDS:
+        # La clave evita repetir el aviso si el job corre dos veces para el mismo día
+        queue_notification(context, f"report:{day}", ADMIN_IDS, format_report(report), parse_mode=None)
 
 # ==========================================
 # FUNCIONES PRINCIPALES (ADMIN Y CLIENTE)
@@ -102,12 +2031,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Determinar si es admin
     if es_admin(uid):
-        keyboard = [
-            [InlineKeyboardButton("➕ Agregar Producto", callback_data="admin_add_start")],
-            [InlineKeyboardButton("📦 Gestionar Pedidos", callback_data="admin_orders")],
-            [InlineKeyboardButton("📊 Ver Balance", callback_data="admin_balance")],
-            [InlineKeyboardButton("🗑️ Borrar Menú", callback_data="admin_clear")]
-        ]
         text = "👋 Admin Panel de DolceZZa"
     else:
         # Si es cliente, verificar si ya eligió zona en esta sesión
@@ -118,160 +2041,213 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await main_menu(update, context)
 
     # Enviar el mensaje (Nuevo o Editado)
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = ADMIN_KEYBOARD
     try:
         if is_callback:
             await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
         else:
             await update.message.reply_text(text, reply_markup=reply_markup)
-    except Exception as e:
-        # Si el mensaje no cambió, ignorar error para no crashear
-        pass
+    except BadRequest as e:
+        # Si el mensaje no cambió no hay nada que hacer
+        if not is_not_modified(e): raise
 
 # ==========================================
 # LÓGICA DEL CLIENTE
 # ==========================================
 
 async def select_zone_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = []
-    zonas_list = list(ZONES_PRICES.keys())
-    for i in range(0, len(zonas_list), 2):
-        row = []
-        row.append(InlineKeyboardButton(zonas_list[i], callback_data=f"zone_{zonas_list[i]}"))
-        if i + 1 < len(zonas_list):
-            row.append(InlineKeyboardButton(zonas_list[i+1], callback_data=f"zone_{zonas_list[i+1]}"))
-        keyboard.append(row)
-    
     text = "📍 **Bienvenido a DolceZZa** 🍬\n\nPor favor selecciona tu zona para calcular la mensajería:"
-    markup = InlineKeyboardMarkup(keyboard)
+    markup = ZONES.keyboard
     
     try:
         if update.callback_query:
             await update.callback_query.edit_message_text(text, reply_markup=markup, parse_mode="Markdown")
         else:
             await update.message.reply_text(text, reply_markup=markup, parse_mode="Markdown")
-    except:
-        pass
+    except BadRequest as e:
+        if not is_not_modified(e): raise
 
 async def set_zone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    zone_name = query.data.split("zone_")[1]
-    context.user_data['zone'] = zone_name
+    key = query.data.split("_", 1)[1]
+    # Los botones enviados antes de los códigos llevan el nombre de la zona
+    code = int(key) if key.isdigit() else ZONES.code_by_name.get(key)
+    if code not in ZONES.by_code:
+        await select_zone_start(update, context)
+        return
+    context.user_data['zone_code'] = code
+    context.user_data['zone'] = ZONES.by_code[code][0]
     await main_menu(update, context)
 
 async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cart_count = sum(item['qty'] for item in context.user_data.get('cart', []))
+    cart_count = get_cart(context.user_data).count
     zone_name = context.user_data.get('zone', 'No definida')
+    markup = main_menu_keyboard(cart_count)
     
-    keyboard = [
-        [InlineKeyboardButton(f"🍬 Ver Menú", callback_data="view_menu")],
-        [InlineKeyboardButton(f"🛒 Mi Carrito ({cart_count})", callback_data="view_cart")],
-        [InlineKeyboardButton(f"📦 Mis Pedidos", callback_data="my_orders")],
-        [InlineKeyboardButton(f"📍 Cambiar Zona", callback_data="change_zone")]
-    ]
-    
-    text = f"🍭 *DolceZZa - Dulcería*\n\nZona actual: {zone_name}"
+    text = f"🍭 *DolceZZa - Dulcería*\n\nZona actual: {md(zone_name)}"
     
+    query = update.callback_query
     try:
-        if update.callback_query:
-            await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        if not query:
+            await update.message.reply_text(text, reply_markup=markup, parse_mode="Markdown")
+        elif query.message.photo:
+            # El visor de la galería (o una ficha) no se puede convertir en texto
+            await context.bot.send_message(query.message.chat_id, text, reply_markup=markup, parse_mode="Markdown")
+            await query.delete_message()
+            if context.chat_data.get("viewer") == query.message.message_id:
+                context.chat_data.pop("viewer")
         else:
-            await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
-    except:
-        pass
+            await query.edit_message_text(text, reply_markup=markup, parse_mode="Markdown")
+    except BadRequest as e:
+        if not is_not_modified(e): raise
+
+async def back_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    await main_menu(update, context)
 
 async def view_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    data = load_data()
-    if not data["menu"]:
-        keyboard = [[InlineKeyboardButton("🔙 Volver", callback_data="back_main")]]
-        await query.edit_message_text("🕒 No hay dulces disponibles hoy.", reply_markup=InlineKeyboardMarkup(keyboard))
+    markup = get_menu_keyboard()
+    text = "📜 *Menú del Día*\nToca un dulce para ver detalles:" if markup else "🕒 No hay dulces disponibles hoy."
+    markup = markup or BACK_MAIN_KEYBOARD
+    
+    if query.message.photo:
+        # Un mensaje con foto no se puede convertir en texto
+        if GALLERY_MODE and markup is not BACK_MAIN_KEYBOARD:
+            await query.edit_message_caption(text, reply_markup=markup, parse_mode="Markdown")
+            return
+        await context.bot.send_message(query.message.chat_id, text, reply_markup=markup, parse_mode="Markdown")
+        await query.delete_message()
         return
+    
+    await query.edit_message_text(text, reply_markup=markup, parse_mode="Markdown")
 
-    keyboard = []
-    for item in data["menu"]:
-        keyboard.append([InlineKeyboardButton(f"🍩 {item['name']} - {item['price']} CUP", callback_data=f"prod_{item['id']}")])
-    keyboard.append([InlineKeyboardButton("🔙 Volver", callback_data="back_main")])
+async def view_gallery(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    products = [p for p in storage.get_menu() if product_photo(p) and inventory.available(p["id"]) != 0]
+    if not products:
+        await query.answer("🕒 No hay fotos en el menú de hoy.", show_alert=True)
+        return
+    
+    # Si el chat ya tiene los álbumes del menú actual no se reenvían
+    album = context.chat_data.get("album")
+    if album and album["version"] == menu_version:
+        await query.answer("📸 Las fotos del menú ya están más arriba en el chat.")
+        return
+    await query.answer()
     
-    await query.edit_message_text("📜 *Menú del Día*\nToca un dulce para ver detalles:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    message_ids = []
+    for i in range(0, len(products), ALBUM_SIZE):
+        messages = await send_album(context.bot, query.message.chat_id, products[i:i + ALBUM_SIZE])
+        message_ids += [m.message_id for m in messages]
+    context.chat_data["album"] = {"version": menu_version, "message_ids": message_ids}
 
 async def view_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     prod_id = query.data.split("_")[1]
     
-    data = load_data()
-    product = next((p for p in data["menu"] if p["id"] == prod_id), None)
+    product = storage.get_product(prod_id)
     
     if not product: return
 
-    keyboard = [
-        [InlineKeyboardButton("➕ Agregar al Carrito", callback_data=f"addcart_{prod_id}")],
-        [InlineKeyboardButton("🔙 Volver al Menú", callback_data="view_menu")]
-    ]
+    markup = product_keyboard(prod_id)
+    caption = product_caption(product)
+    
+    if GALLERY_MODE and product_photo(product):
+        if await show_in_viewer(context, query, product, markup):
+            return
     
-    caption = f"*{product['name']}*\n💰 Precio: {product['price']} CUP"
+    if product_photo(product):
+        try:
+            message = await context.bot.send_photo(chat_id=query.message.chat_id, photo=product_photo(product), caption=caption, reply_markup=markup, parse_mode="Markdown")
+        except BadRequest as e:
+            if not is_bad_photo(e): raise
+            PHOTO_CACHE[product["id"]] = None
+        else:
+            remember_photo(product, message)
+            if GALLERY_MODE:
+                # El menú se queda en el chat y las siguientes fichas editan esta
+                context.chat_data["viewer"] = message.message_id
+            else:
+                await query.delete_message()
+            return
     
-    if product.get("photo_id"):
-        await context.bot.send_photo(chat_id=query.message.chat_id, photo=product["photo_id"], caption=caption, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    if query.message.photo:
+        await context.bot.send_message(query.message.chat_id, caption, reply_markup=markup, parse_mode="Markdown")
         await query.delete_message()
     else:
-        await query.edit_message_text(caption, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await query.edit_message_text(caption, reply_markup=markup, parse_mode="Markdown")
 
 async def add_to_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     prod_id = query.data.split("_")[1]
     
-    data = load_data()
-    product = next((p for p in data["menu"] if p["id"] == prod_id), None)
+    product = storage.get_product(prod_id)
     
-    if not product: return
+    if not product:
+        await query.answer()
+        return
     
-    if 'cart' not in context.user_data: context.user_data['cart'] = []
+    cart = get_cart(context.user_data)
+    if not inventory.can_sell(prod_id, cart.get(prod_id, 0) + 1):
+        available = inventory.available(prod_id)
+        await query.answer("😔 Agotado." if not available else f"😔 Solo quedan {available}.", show_alert=True)
+        return
+    cart.add(prod_id)
     
-    found = False
-    for item in context.user_data['cart']:
-        if item['id'] == prod_id:
-            item['qty'] += 1
-            found = True
-            break
-    if not found:
-        context.user_data['cart'].append({"id": product['id'], "name": product['name'], "price": product['price'], "qty": 1})
+    if GALLERY_MODE and query.message.photo:
+        # La ficha sigue abierta para seguir navegando; basta con el aviso
+        await query.answer(f"✅ {product['name']} agregado.")
+        return
+    await query.answer()
     
     keyboard = [[InlineKeyboardButton("🔙 Volver al Menú", callback_data="view_menu")]]
+    text = f"✅ {md_bold(product['name'])} agregado."
     try:
-        await query.edit_message_text(f"✅ *{product['name']}* agregado.", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
-    except:
-        pass
+        if query.message.photo:
+            await query.edit_message_caption(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        else:
+            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    except BadRequest as e:
+        if not is_not_modified(e): raise
 
 async def view_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    
-    cart = context.user_data.get('cart', [])
-    if not cart:
-        keyboard = [[InlineKeyboardButton("🔙 Volver", callback_data="back_main")]]
-        await query.edit_message_text("🛒 Tu carrito está vacío.", reply_markup=InlineKeyboardMarkup(keyboard))
+    await show_cart(query, get_cart(context.user_data))
+
+async def show_cart(query, cart):
+    text, total = cart.summary()
+    if not text:
+        await query.edit_message_text("🛒 Tu carrito está vacío.", reply_markup=BACK_MAIN_KEYBOARD)
         return
     
-    text, total = get_cart_summary(cart)
     text += f"\n----------------\n💰 *Total Dulces: {total} CUP*"
-    
-    keyboard = [
-        [InlineKeyboardButton("🚀 Realizar Pedido", callback_data="start_checkout")],
-        [InlineKeyboardButton("🗑️ Vaciar Carrito", callback_data="clear_cart")],
-        [InlineKeyboardButton("🔙 Volver", callback_data="back_main")]
-    ]
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    await query.edit_message_text(text, reply_markup=cart.keyboard(), parse_mode="Markdown")
+
+async def update_cart_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Botones −/+ del carrito (callback c-<id> / c+<id>)"""
+    query = update.callback_query
+    sign, prod_id = query.data[1], query.data[2:]
+    cart = get_cart(context.user_data)
+    if prod_id not in cart:
+        await query.answer()
+        return
+    if sign == "+" and not inventory.can_sell(prod_id, cart[prod_id] + 1):
+        await query.answer("😔 No quedan más unidades.", show_alert=True)
+        return
+    await query.answer()
+    cart.add(prod_id, 1 if sign == "+" else -1)
+    await show_cart(query, cart)
 
 async def clear_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    context.user_data['cart'] = []
+    get_cart(context.user_data).clear()
     await query.edit_message_text("🗑️ Carrito vaciado.")
     await main_menu(update, context)
 
@@ -300,16 +2276,28 @@ async def checkout_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def checkout_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['order_phone'] = update.message.text
     
-    cart = context.user_data.get('cart', [])
-    items_text, subtotal = get_cart_summary(cart)
-    zone = context.user_data.get('zone')
-    delivery_cost = ZONES_PRICES.get(zone, 0)
+    cart = get_cart(context.user_data)
+    missing = inventory.shortages(order_quantities(cart.lines()))
+    if missing:
+        await update.message.reply_text(shortage_text(missing), reply_markup=main_menu_keyboard(cart.count))
+        return ConversationHandler.END
+    _, subtotal = cart.summary()
+    code = ZONES.resolve(context.user_data)
+    if code is None:
+        await update.message.reply_text("📍 Tu zona ya no está disponible. Elige otra y vuelve a finalizar desde el carrito:", reply_markup=ZONES.keyboard)
+        return ConversationHandler.END
+    zone = context.user_data['zone']
+    delivery_cost = ZONES.delivery(code, subtotal)
     total_final = subtotal + delivery_cost
     
     context.user_data['order_totals'] = {'subtotal': subtotal, 'delivery': delivery_cost, 'total': total_final}
     
-    text = (f"🧾 *PRE-TICKET*\n\n👤 {context.user_data['order_name']}\n📍 {zone}\n🏠 {context.user_data['order_address']}\n📞 {context.user_data['order_phone']}\n\n"
-             f"{items_text}\n----------------\n🛍️ Subtotal: {subtotal} CUP\n🛵 Mensajería: {delivery_cost} CUP\n💰 *TOTAL: {total_final} CUP*")
+    draft = {
+        "order_id": None, "user_name": context.user_data['order_name'], "user_phone": context.user_data['order_phone'],
+        "address": context.user_data['order_address'], "zone": zone, "items": cart.lines(), "subtotal": subtotal,
+        "delivery_cost": delivery_cost, "total": total_final, "status": "PENDIENTE",
+    }
+    text = render_order("ticket", draft)
     
     keyboard = [
         [InlineKeyboardButton("✅ CONFIRMAR PEDIDO", callback_data="confirm_order_accept")],
@@ -322,71 +2310,125 @@ async def confirm_order_accept(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     
-    cart = context.user_data.get('cart', [])
+    cart = get_cart(context.user_data)
     totals = context.user_data.get('order_totals')
-    order_id = datetime.now().strftime("%Y%m%d%H%M%S")
+    items = cart.lines()
+    
+    # Un segundo toque en confirmar o un carrito editado después del pre-ticket no generan un pedido distinto al mostrado
+    if not items or not totals or cart.summary()[1] != totals['subtotal']:
+        await query.edit_message_text("🛒 Tu carrito cambió o ya se envió. Revísalo y vuelve a finalizar el pedido.", reply_markup=main_menu_keyboard(cart.count))
+        return
     
     new_order = {
-        "order_id": order_id, "user_id": query.from_user.id, "user_name": context.user_data['order_name'],
+        "order_id": None, "user_id": query.from_user.id, "user_name": context.user_data['order_name'],
         "user_phone": context.user_data['order_phone'], "address": context.user_data['order_address'],
-        "zone": context.user_data['zone'], "items": cart, "subtotal": totals['subtotal'],
+        "zone": context.user_data['zone'], "items": items, "subtotal": totals['subtotal'],
         "delivery_cost": totals['delivery'], "total": totals['total'], "status": "PENDIENTE",
         "date": datetime.now().strftime("%d/%m/%Y %H:%M")
     }
     
-    data = load_data()
-    data["orders"].append(new_order)
-    save_data(data)
-    context.user_data['cart'] = []
+    # Comprobar y apartar las existencias en la misma transacción que guarda el pedido
+    quantities = order_quantities(items)
+    async with transaction():
+        missing = inventory.shortages(quantities)
+        if not missing:
+            order_id = storage.add_order(new_order)
+            inventory.reserve(order_id, quantities)
+            cart.clear()
+            context.user_data.pop('order_totals', None)
+    if missing:
+        await query.edit_message_text(shortage_text(missing), reply_markup=main_menu_keyboard(cart.count))
+        return
     
     await query.edit_message_text(f"✅ *Pedido Enviado a DolceZZa*.\nEspera confirmación.", parse_mode="Markdown")
     
     # --- NOTIFICAR A TODOS LOS ADMINS ---
-    items_text, _ = get_cart_summary(cart)
-    admin_text = (f"🆕 *PEDIDO #{order_id}*\n\n👤 {new_order['user_name']}\n📍 {new_order['zone']}\n🏠 {new_order['address']}\n📞 {new_order['user_phone']}\n\n"
-                  f"{items_text}\n----------------\n🛵 Mensajería: {new_order['delivery_cost']} CUP\n💰 *TOTAL: {new_order['total']} CUP*")
+    admin_text = render_order("admin_notice", new_order)
     
     admin_keyboard = [
         [InlineKeyboardButton("✅ Aceptar", callback_data=f"adm_accept_{order_id}")],
         [InlineKeyboardButton("❌ Rechazar", callback_data=f"adm_reject_{order_id}")]
     ]
     
-    # Enviar a cada ID en la lista ADMIN_IDS
+    # Encolar el aviso para todos los ADMIN_IDS (se envían en paralelo en segundo plano)
     if not ADMIN_IDS:
-        print("ADVERTENCIA: No hay administradores configurados en ADMIN_IDS")
+        logger.warning("No hay administradores configurados en ADMIN_IDS")
     else:
-        for admin_id in ADMIN_IDS:
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=admin_text,
-                    reply_markup=InlineKeyboardMarkup(admin_keyboard),
-                    parse_mode="Markdown"
-                )
-            except Exception as e:
-                print(f"Error notificando al admin {admin_id}: {e}")
+        queue_notification(context, f"{order_id}:PENDIENTE", ADMIN_IDS, admin_text, InlineKeyboardMarkup(admin_keyboard))
 
 async def confirm_order_reject(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    context.user_data.pop('order_totals', None)
     await query.edit_message_text("❌ Pedido cancelado.")
     await main_menu(update, context)
 
+MY_ORDERS_PAGE = 3
+
 async def my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = load_data()
-    my_orders_list = [o for o in data["orders"] if o["user_id"] == query.from_user.id]
+    uid = query.from_user.id
+    
+    # "my_orders" muestra los más recientes; "myord_o_<seq>" los anteriores a seq y "myord_n_<seq>" los posteriores
+    page = []
+    if query.data.startswith("myord_"):
+        _, direction, cursor = query.data.split("_")
+        if direction == "o":
+            page = storage.get_user_orders(uid, MY_ORDERS_PAGE, before=int(cursor))
+        else:
+            page = storage.get_user_orders_after(uid, int(cursor), MY_ORDERS_PAGE)[::-1]
+    if not page:
+        page = storage.get_user_orders(uid, MY_ORDERS_PAGE)
     
-    if not my_orders_list:
-        await query.edit_message_text("No hay pedidos.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver", callback_data="back_main")]]))
+    if not page:
+        await query.edit_message_text("No hay pedidos.", reply_markup=BACK_MAIN_KEYBOARD)
         return
     
     text = "📦 *Tus Pedidos:*\n\n"
-    for o in reversed(my_orders_list[-3:]):
+    for o in page:
         text += f"🧾 #{o['order_id']} - {o['date']}\nEstado: *{o['status']}*\nTotal: {o['total']} CUP\n\n"
+    
+    nav = []
+    if storage.get_user_orders_after(uid, page[0]["seq"], 1):
+        nav.append(InlineKeyboardButton("⬅️ Más recientes", callback_data=f"myord_n_{page[0]['seq']}"))
+    if storage.get_user_orders(uid, 1, before=page[-1]["seq"]):
+        nav.append(InlineKeyboardButton("Anteriores ➡️", callback_data=f"myord_o_{page[-1]['seq']}"))
+    elif archive_months():
+        nav.append(InlineKeyboardButton("📚 Pedidos archivados", callback_data="myarch"))
+    keyboard = [nav] if nav else []
+    keyboard.append([InlineKeyboardButton("🔙 Volver", callback_data="back_main")])
         
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver", callback_data="back_main")]]), parse_mode="Markdown")
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+
+async def my_archived_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Historial archivado del cliente: un mes por página, solo se lee si lo pide"""
+    query = update.callback_query
+    await query.answer()
+    uid = query.from_user.id
+    
+    # "myarch" empieza por el mes más reciente; "myarch_<AAAA-MM>" sigue por los anteriores a ese mes
+    cursor = query.data.split("_")[1] if "_" in query.data else None
+    months = [m for m in archive_months() if cursor is None or m < cursor]
+    page, month = [], None
+    for month in months:
+        page = read_archive(month, uid)
+        if page:
+            break
+    
+    if not page:
+        await query.edit_message_text("No hay más pedidos archivados.", reply_markup=BACK_MAIN_KEYBOARD)
+        return
+    
+    text = f"📚 *Pedidos archivados ({month}):*\n\n"
+    for o in page:
+        text += f"🧾 #{o['order_id']} - {o['date']}\nEstado: *{o['status']}*\nTotal: {o['total']} CUP\n\n"
+    
+    keyboard = []
+    if any(m < month for m in months):
+        keyboard.append([InlineKeyboardButton("Meses anteriores ➡️", callback_data=f"myarch_{month}")])
+    keyboard.append([InlineKeyboardButton("🔙 Volver", callback_data="back_main")])
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
 # ==========================================
 # LÓGICA DEL ADMINISTRADOR
@@ -430,10 +2472,8 @@ async def admin_skip_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def save_new_product(context, photo_id, message_obj):
-    data = load_data()
-    new_item = {"id": str(uuid.uuid4()), "name": context.user_data['prod_name'], "price": context.user_data['prod_price'], "photo_id": photo_id}
-    data["menu"].append(new_item)
-    save_data(data)
+    new_item = storage.add_product(context.user_data['prod_name'], context.user_data['prod_price'], photo_id)
+    invalidate_menu_keyboard()
     
     keyboard = [[InlineKeyboardButton("🔙 Menú Admin", callback_data="start")]]
     await message_obj.reply_text(f"✅ Guardado: {new_item['name']} - {new_item['price']} CUP", reply_markup=InlineKeyboardMarkup(keyboard))
@@ -442,21 +2482,25 @@ async def admin_orders_mgmt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    data = load_data()
-    active_orders = [o for o in data["orders"] if o["status"] in ["PENDIENTE", "ACEPTADO"]]
+    # "admin_orders" muestra el pedido activo más antiguo; "admq_n_<seq>" el
+    # siguiente a seq y "admq_p_<seq>" el anterior (cada página es un pedido)
+    page = []
+    if query.data.startswith("admq_"):
+        _, direction, cursor = query.data.split("_")
+        if direction == "n":
+            page = storage.get_active_orders(1, after=int(cursor))
+        else:
+            page = storage.get_active_orders_before(int(cursor), 1)
+    if not page:
+        page = storage.get_active_orders(1)
     
-    if not active_orders:
+    if not page:
         keyboard = [[InlineKeyboardButton("🔙 Menú Admin", callback_data="start")]]
         await query.edit_message_text("No hay pedidos activos.", reply_markup=InlineKeyboardMarkup(keyboard))
         return
     
-    # Mostrar el primero
-    o = active_orders[0]
-    items_text, _ = get_cart_summary(o['items'])
-    status_emoji = "⏳" if o['status'] == "PENDIENTE" else "✅"
-    
-    text = (f"📦 *Pedido #{o['order_id']}*\nEstado: {status_emoji} {o['status']}\n\n👤 {o['user_name']}\n📍 {o['zone']}\n🏠 {o['address']}\n📞 {o['user_phone']}\n\n"
-             f"{items_text}\n----------------\n💰 *TOTAL: {o['total']} CUP*")
+    o = page[0]
+    text = render_order("admin_card", o)
     
     keyboard = []
     if o['status'] == "PENDIENTE":
@@ -464,8 +2508,13 @@ async def admin_orders_mgmt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif o['status'] == "ACEPTADO":
         keyboard.append([InlineKeyboardButton("🏁 Marcar Entregado", callback_data=f"adm_done_{o['order_id']}")])
     
-    if len(active_orders) > 1:
-        keyboard.append([InlineKeyboardButton("⏭️ Siguiente Pedido", callback_data="admin_orders")])
+    nav = []
+    if storage.get_active_orders_before(o['seq'], 1):
+        nav.append(InlineKeyboardButton("⏮️ Anterior", callback_data=f"admq_p_{o['seq']}"))
+    if storage.get_active_orders(1, after=o['seq']):
+        nav.append(InlineKeyboardButton("⏭️ Siguiente Pedido", callback_data=f"admq_n_{o['seq']}"))
+    if nav:
+        keyboard.append(nav)
     keyboard.append([InlineKeyboardButton("🔙 Menú Admin", callback_data="start")])
     
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
@@ -475,45 +2524,52 @@ async def admin_action_order(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     
     action, order_id = query.data.split("_")[1], query.data.split("_")[2]
-    data = load_data()
-    order = next((o for o in data["orders"] if o["order_id"] == order_id), None)
-    
-    if not order: return
-    
-    msg_cliente = ""
     reset_user = False
     
     if action == "accept":
-        order["status"] = "ACEPTADO"
-        msg_cliente = f"✅ *Pedido #{order_id} ACEPTADO* en DolceZZa."
+        new_status = "ACEPTADO"
         admin_msg = "Pedido Aceptado."
     elif action == "reject":
-        order["status"] = "RECHAZADO"
-        msg_cliente = f"❌ *Pedido #{order_id} RECHAZADO*."
+        new_status = "RECHAZADO"
         admin_msg = "Pedido Rechazado."
     elif action == "done":
-        order["status"] = "REALIZADO"
-        msg_cliente = f"🏁 *Pedido #{order_id} ENTREGADO*.\n¡Gracias por comprar en DolceZZa!"
+        new_status = "REALIZADO"
         admin_msg = "Pedido Entregado."
         reset_user = True
     
-    save_data(data)
+    # Leer y cambiar el estado en una sola transacción: si otro admin ya actuó
+    # sobre el pedido, no se vuelve a cambiar ni a avisar al cliente
+    async with transaction():
+        order = storage.get_order(order_id)
+        if not order: return
+        current_status = order["status"]
+        if current_status in ORDER_TRANSITIONS[action]:
+            storage.set_order_status(order_id, new_status)
+            invalidate_order_render(order_id)
+            if action == "accept":
+                inventory.keep(order_id)
+            elif action == "reject":
+                inventory.release(order_id)
+            else:
+                inventory.consume(order_id)
+    
+    if current_status not in ORDER_TRANSITIONS[action]:
+        keyboard = [[InlineKeyboardButton("🔙 Menú Admin", callback_data="start")]]
+        await query.edit_message_text(f"ℹ️ El pedido #{order_id} ya está {current_status}.", reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+    
+    # Notificar cliente (en segundo plano; si falla se avisa al admin)
+    msg_cliente = render_order("customer_status", dict(order, status=new_status))
+    user_keyboard = None
+    if reset_user:
+        user_keyboard = [[InlineKeyboardButton("🔄 Iniciar Nuevo Pedido", callback_data="start")]] # Usar 'start' para reiniciar
+    queue_notification(
+        context, f"{order_id}:{new_status}", [order["user_id"]], msg_cliente,
+        reply_markup=InlineKeyboardMarkup(user_keyboard) if user_keyboard else None,
+        report_chat_id=query.from_user.id,
+        report_text=f"⚠️ No se pudo avisar al cliente del pedido #{order_id}. Contáctalo al {order['user_phone']}."
+    )
     
-    # Notificar cliente
-    try:
-        user_keyboard = None
-        if reset_user:
-            user_keyboard = [[InlineKeyboardButton("🔄 Iniciar Nuevo Pedido", callback_data="start")]] # Usar 'start' para reiniciar
-        
-        await context.bot.send_message(
-            chat_id=order["user_id"], 
-            text=msg_cliente, 
-            reply_markup=InlineKeyboardMarkup(user_keyboard) if user_keyboard else None,
-            parse_mode="Markdown"
-        )
-    except:
-        pass
-        
     # Volver al menú admin automáticamente tras la acción
     keyboard = [[InlineKeyboardButton("🔙 Menú Admin", callback_data="start")]]
     await query.edit_message_text(f"{admin_msg}\n\nPresiona 'Menú Admin' para volver.", reply_markup=InlineKeyboardMarkup(keyboard))
@@ -521,40 +2577,664 @@ async def admin_action_order(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def admin_clear_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = load_data()
-    data["menu"] = []
-    save_data(data)
+    storage.clear_menu()
+    invalidate_menu_keyboard()
     
     keyboard = [[InlineKeyboardButton("🔙 Menú Admin", callback_data="start")]]
     await query.edit_message_text("🗑️ Menú eliminado.", reply_markup=InlineKeyboardMarkup(keyboard))
 
+IMPORT_HELP = (
+    "📥 *Importar Menú*\n\n"
+    "Envía un archivo *.csv* o *.json* con las columnas `nombre`, `precio` y opcionalmente `foto`, `id` "
+    "y `existencias` (las mismas que da *Exportar Menú*). Sin existencias el producto no tiene límite.\n\n"
+    "Por defecto el archivo *reemplaza* el menú. Escribe `agregar` en el pie del archivo para "
+    "combinarlo con el menú actual."
+)
+
+async def admin_import_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [[InlineKeyboardButton("🔙 Menú Admin", callback_data="start")]]
+    if update.callback_query:
+        await update.callback_query.answer()
+        await update.callback_query.edit_message_text(IMPORT_HELP, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    elif es_admin(update.effective_user.id):
+        await update.message.reply_text(IMPORT_HELP, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+
+async def admin_import_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not es_admin(update.effective_user.id):
+        return
+    document = update.message.document
+    if document.file_size and document.file_size > MENU_FILE_MAX_BYTES:
+        await update.message.reply_text("❌ El archivo es demasiado grande (máximo 1 MB).")
+        return
+    
+    file = await document.get_file()
+    content = bytes(await file.download_as_bytearray())
+    try:
+        rows = parse_menu_file(content, document.file_name or "")
+    except ValueError as e:
+        await update.message.reply_text(f"❌ No se importó nada:\n{e}")
+        return
+    
+    merge = (update.message.caption or "").strip().lower() in ("agregar", "combinar", "merge")
+    async with transaction():
+        current = storage.get_menu()
+        photos = {p["id"]: p.get("photo_id") for p in current}
+        menu = storage.replace_menu(build_imported_menu(current, rows, merge))
+    invalidate_menu_keyboard()
+    for p in menu:
+        if p.get("photo_id") != photos.get(p["id"]):
+            PHOTO_CACHE.pop(p["id"], None)
+    
+    before = set(photos)
+    
+    after = {p["id"] for p in menu}
+    keyboard = [[InlineKeyboardButton("🔙 Menú Admin", callback_data="start")]]
+    await update.message.reply_text(
+        f"✅ Menú {'combinado' if merge else 'reemplazado'}: {len(menu)} productos\n"
+        f"➕ Nuevos: {len(after - before)}\n✏️ Actualizados: {len(after & before)}\n🗑️ Retirados: {len(before - after)}",
+        reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def admin_export_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query:
+        await query.answer()
+        fmt = "csv"
+    elif es_admin(update.effective_user.id):
+        fmt = "json" if context.args and context.args[0].lower() == "json" else "csv"
+    else:
+        return
+    
+    menu = storage.get_menu()
+    if not menu:
+        await context.bot.send_message(update.effective_chat.id, "🕒 El menú está vacío.")
+        return
+    filename = f"menu-{datetime.now():%Y%m%d}.{fmt}"
+    await context.bot.send_document(update.effective_chat.id, InputFile(export_menu(menu, fmt), filename=filename),
+                                    caption=f"📤 {len(menu)} productos. Edítalo y reenvíalo para importarlo.")
+
+async def admin_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stock lista las existencias; /stock <id> <unidades|-> las fija (- = sin límite)"""
+    if not es_admin(update.effective_user.id):
+        return
+    if not context.args:
+        lines = []
+        for p in storage.get_menu():
+            if p.get("stock") is not None:
+                lines.append(f"{p['id']:<5}{p['name'][:20]:<21}{p['stock']:>5}{inventory.available(p['id']):>6}")
+        text = "📦 Sin productos con existencias." if not lines else \
+            "📦 *Existencias*\n```\n" + f"{'id':<5}{'producto':<21}{'stock':>5}{'disp':>6}\n" + "\n".join(lines) + "\n```"
+        await update.message.reply_text(text, parse_mode="Markdown")
+        return
+    
+    product = storage.get_product(context.args[0])
+    value = context.args[1] if len(context.args) > 1 else ""
+    if not product or not (value == "-" or value.isdigit()):
+        await update.message.reply_text("Uso: /stock <id> <unidades|->")
+        return
+    stock = None if value == "-" else int(value)
+    async with transaction():
+        inventory.set_stock(product["id"], stock)
+    available = inventory.available(product["id"])
+    await update.message.reply_text(f"✅ {product['name']}: " + ("sin límite." if stock is None else f"{stock} en stock, {available} disponibles."))
+
+def fmt_seconds(seconds):
+    if seconds == float("inf"):
+        return f">{LATENCY_BUCKETS[-1]:g}s"
+    return f"{seconds * 1000:g}ms" if seconds < 1 else f"{seconds:g}s"
+
+def fmt_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def format_stats():
+    """Resumen de las métricas para /stats (bloque de código para que los nombres no rompan el Markdown)"""
+    uptime = int(time.time() - metrics.started)
+    lines = [f"{'handler':<22}{'n':>7}{'p50':>8}{'p99':>8}{'err':>5}"]
+    errors = {l["handler"]: n for l, n in metrics.series("handler_errors_total")}
+    for labels, hist in sorted(metrics.series("handler_seconds"), key=lambda r: r[1].count, reverse=True)[:15]:
+        lines.append(f"{labels['handler'][:21]:<22}{hist.count:>7}{fmt_seconds(hist.quantile(0.5)):>8}"
+                     f"{fmt_seconds(hist.quantile(0.99)):>8}{errors.get(labels['handler'], 0):>5}")
+    
+    lines.append("")
+    written = {l["op"]: n for l, n in metrics.series("storage_bytes_total")}
+    for labels, hist in sorted(metrics.series("storage_seconds"), key=lambda r: r[0]["op"]):
+        lines.append(f"{labels['op']:<11}{hist.count:>6} × {hist.sum / hist.count * 1000:7.1f}ms  {fmt_bytes(written.get(labels['op'], 0)):>9}")
+    
+    lines.append("")
+    dropped = {l["reason"]: n for l, n in metrics.series("updates_dropped_total")}
+    lines.append(f"Descartados: {dropped.get('rate', 0)} por ritmo, {dropped.get('duplicate', 0)} repetidos")
+    
+    lines.append("")
+    calls = sorted(metrics.series("api_calls_total"), key=lambda r: r[1], reverse=True)
+    api_errors = metrics.series("api_errors_total")
+    lines.append(f"Bot API: {sum(n for _, n in calls)} llamadas, {sum(n for _, n in api_errors)} errores")
+    for labels, n in calls[:8]:
+        lines.append(f"  {labels['method']:<24}{n:>7}")
+    for labels, n in sorted(api_errors, key=lambda r: r[1], reverse=True)[:5]:
+        lines.append(f"  ⚠️ {labels['method']} {labels['error']}: {n}")
+    
+    header = f"📈 *Estadísticas* (activo hace {uptime // 3600}h {uptime % 3600 // 60}m)"
+    return header + "\n```\n" + "\n".join(lines) + "\n```"
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not es_admin(update.effective_user.id):
+        return
+    await update.message.reply_text(format_stats(), parse_mode="Markdown")
+
+async def admin_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not es_admin(update.effective_user.id):
+        return
+    day = context.args[0] if context.args else datetime.now().strftime("%Y-%m-%d")
+    try:
+        datetime.strptime(day, "%Y-%m-%d")
+    except ValueError:
+        await update.message.reply_text("Uso: /reporte [AAAA-MM-DD]")
+        return
+    
+    async def send_report(chat_id):
+        report = await build_daily_report(day)
+        await context.bot.send_message(chat_id, format_report(report))
+        with open(os.path.join(report["folder"], "pedidos.csv"), "rb") as f:
+            await context.bot.send_document(chat_id, InputFile(f.read(), filename=f"pedidos-{day}.csv"))
+    
+    # El cálculo corre aparte: el handler responde enseguida
+    context.application.create_task(send_report(update.effective_chat.id), update=update)
+    await update.message.reply_text(f"⏳ Generando el reporte del {day}...")
+
 async def admin_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     total, count = get_balance()
     
     text = f"📊 *Balance - DolceZZa*\n\n🏁 Entregados: {count}\n💰 Recaudado: {total} CUP"
-    keyboard = [[InlineKeyboardButton("🔙 Menú Admin", callback_data="start")]]
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    await query.edit_message_text(text, reply_markup=BALANCE_KEYBOARD, parse_mode="Markdown")
+
+async def admin_balance_view(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    view = query.data.split("_", 1)[1]
+    today = datetime.now()
+    
+    if view == "zone":
+        rows = sorted(storage.get_balance_by_zone(), key=lambda r: r[2], reverse=True)
+        text = "📍 *Balance por Zona*\n\n"
+        if not rows:
+            text += "Sin entregas todavía."
+        for zone, count, total in rows:
+            text += f"{md(zone)}: {count} entregados - {total} CUP\n"
+    else:
+        if view == "month":
+            start, title = today.replace(day=1), "Este mes"
+        else:
+            days = int(view)
+            start, title = today - timedelta(days=days - 1), "Hoy" if days == 1 else f"Últimos {days} días"
+        total, count = storage.get_balance_between(start.strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d"))
+        text = f"📅 *Balance - {title}*\n\n🏁 Entregados: {count}\n💰 Recaudado: {total} CUP"
+    
+    await query.edit_message_text(text, reply_markup=BALANCE_KEYBOARD, parse_mode="Markdown")
 
 # ==========================================
 # MAIN Y HANDLERS (EL CORAZÓN DEL BOT)
 # ==========================================
 
-def main():
-    application = Application.builder().token(TOKEN).build()
+# --- ARRANQUE Y APAGADO ---
+# post_init deja todo listo antes de aceptar updates: base leída e indexada,
+# reservas de existencias, teclados precalculados y, con webhook, la conexión
+# con la Bot API ya abierta (comprobando de paso el estado del webhook). Cada
+# fase se mide en startup_seconds. Al apagar (SIGTERM de un redespliegue)
+# post_stop entrega los avisos pendientes mientras el bot aún puede enviar,
+# con un límite de SHUTDOWN_DRAIN_TIMEOUT segundos (lo que no salga queda en
+# OUTBOX_FILE), y post_shutdown vuelca y compacta los datos.
+
+WEBHOOK_PATH = "telegram-webhook"
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", 10))
+
+def webhook_url():
+    base = os.environ.get("RENDER_EXTERNAL_URL")
+    return f"{base}/{WEBHOOK_PATH}" if base else None
+
+def warm_up():
+    """Precalienta datos y cachés; devuelve los segundos de cada fase"""
+    phases = {}
+    def phase(name, fn):
+        start = time.perf_counter()
+        fn()
+        phases[name] = time.perf_counter() - start
+        metrics.observe("startup_seconds", phases[name], phase=name)
+    phase("datos", storage.warm)
+    phase("existencias", inventory.load)
+    def keyboards():
+        get_menu_keyboard()
+        for count in range(10):
+            main_menu_keyboard(count)
+    phase("teclados", keyboards)
+    return phases
+
+async def check_webhook(bot):
+    """Primera llamada a la Bot API (abre la conexión) y aviso si el webhook tiene problemas"""
+    url = webhook_url()
+    start = time.perf_counter()
+    try:
+        info = await bot.get_webhook_info()
+    except TelegramError as e:
+        logger.warning("No se pudo consultar el webhook: %s", e)
+        return
+    metrics.observe("startup_seconds", time.perf_counter() - start, phase="webhook")
+    if info.url != url:
+        logger.info("El webhook apunta a %r; se registrará %s", info.url, url)
+    if info.last_error_message:
+        logger.warning("Último error del webhook (%s): %s", info.last_error_date, info.last_error_message)
+    if info.pending_update_count:
+        logger.info("%s updates esperando en Telegram", info.pending_update_count)
+
+async def post_init(application: Application):
+    phases = warm_up()
+    if webhook_url():
+        await check_webhook(application.bot)
+    logger.info("Precalentado en %.0f ms (%s)", sum(phases.values()) * 1000,
+                ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in phases.items()))
+    
+    if FLUSH_INTERVAL > 0:
+        application.job_queue.run_repeating(flush_data_job, interval=FLUSH_INTERVAL, first=FLUSH_INTERVAL, name="flush_data")
+    application.job_queue.run_repeating(outbox_job, interval=OUTBOX_INTERVAL, first=0, name="outbox")
+    if REPORT_TIME:
+        hours, minutes = (int(x) for x in REPORT_TIME.split(":"))
+        local_tz = datetime.now().astimezone().tzinfo
+        application.job_queue.run_daily(report_job, time=dtime(hours, minutes, tzinfo=local_tz), name="daily_report")
+    if ARCHIVE_INTERVAL > 0:
+        application.job_queue.run_repeating(archive_job, interval=ARCHIVE_INTERVAL, first=60, name="archive_orders")
+    if COMPACT_INTERVAL > 0:
+        application.job_queue.run_repeating(compact_data_job, interval=COMPACT_INTERVAL, first=COMPACT_INTERVAL, name="compact_data")
+    if RESERVATION_TIMEOUT > 0:
+        application.job_queue.run_repeating(reservations_job, interval=RESERVATION_CHECK_INTERVAL, first=RESERVATION_CHECK_INTERVAL, name="reservations")
+    if ZONES_RELOAD_INTERVAL > 0:
+        application.job_queue.run_repeating(zones_job, interval=ZONES_RELOAD_INTERVAL, first=ZONES_RELOAD_INTERVAL, name="reload_zones")
+
+async def post_stop(application: Application):
+    # Ya no entran updates pero el bot todavía puede enviar: último intento con los avisos pendientes
+    if not outbox.pending:
+        return
+    try:
+        await asyncio.wait_for(outbox.drain(application.bot), SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Apagado: avisos sin entregar tras %.0f s", SHUTDOWN_DRAIN_TIMEOUT)
+    if outbox.pending:
+        logger.info("Apagado: %s avisos quedan en %s para el próximo arranque", len(outbox.pending), outbox.path)
+
+async def post_shutdown(application: Application):
+    # Garantiza que ningún cambio pendiente se pierda al apagar o redesplegar
+    async with transaction():
+        await storage.compact_async()
+
+# --- LÍMITE DE TOQUES ---
+# Un TypeHandler en el grupo -1 ve cada update antes que los handlers del bot
+# y corta con ApplicationHandlerStop los que no deben llegar a ellos:
+#   - toques repetidos: el mismo botón del mismo mensaje sin que el bot lo
+#     haya editado entre medias (la clave lleva edit_date) dentro de
+#     DUPLICATE_WINDOW segundos. Se responden sin texto para que el cliente
+#     no se quede con el reloj de carga, y no gastan fichas del límite. Los
+#     botones −/+ del carrito se repiten a propósito y quedan fuera. En
+#     GALLERY_MODE también "Agregar" y los productos del menú: la ficha con
+#     foto sigue igual tras agregar y abrir un producto edita el visor, no el
+#     menú, así que un segundo toque legítimo tendría la misma clave. De esos
+#     se encargan el límite de ritmo y las existencias.
+#   - exceso de ritmo: cada usuario tiene un cubo de RATE_LIMIT_BURST fichas
+#     que se rellena a RATE_LIMIT_RATE por segundo (los admins no tienen
+#     límite). Solo el primer toque rechazado recibe aviso; ese toque no
+#     queda registrado como visto y se puede repetir después.
+# Los descartes se cuentan en updates_dropped_total (visibles en /stats).
+
+RATE_LIMIT_RATE = float(os.environ.get("RATE_LIMIT_RATE", 2))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", 10))   # 0 = sin límite
+DUPLICATE_WINDOW = float(os.environ.get("DUPLICATE_WINDOW", 10))
+REPEATABLE_CALLBACKS = ("c+", "c-")
+GALLERY_REPEATABLE_CALLBACKS = ("addcart_", "prod_")
+RATE_LIMIT_MAX_USERS = 10000
+
+class RateLimiter:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}   # user_id -> [fichas, último toque, ya avisado]
+
+    def allow(self, user_id, now):
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            if len(self.buckets) >= RATE_LIMIT_MAX_USERS:
+                self._prune(now)
+            bucket = self.buckets[user_id] = [self.burst, now, False]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True
+        return False
+
+    def first_denial(self, user_id):
+        """True solo en el primer rechazo desde que el cubo se vació"""
+        bucket = self.buckets[user_id]
+        warned, bucket[2] = bucket[2], True
+        return not warned
+
+    def _prune(self, now):
+        # Un cubo que ya se habría rellenado del todo es igual que uno nuevo
+        refill = self.burst / self.rate if self.rate > 0 else float("inf")
+        self.buckets = {uid: b for uid, b in self.buckets.items() if now - b[1] < refill}
+
+class DuplicateGuard:
+    def __init__(self, window):
+        self.window = window
+        self.seen = OrderedDict()   # clave -> momento, en orden de llegada
+
+    def is_duplicate(self, key, now):
+        while self.seen:
+            oldest, seen_at = next(iter(self.seen.items()))
+            if now - seen_at < self.window:
+                break
+            self.seen.popitem(last=False)
+        if key in self.seen:
+            return True
+        self.seen[key] = now
+        return False
+
+    def forget(self, key):
+        self.seen.pop(key, None)
+
+rate_limiter = RateLimiter(RATE_LIMIT_RATE, RATE_LIMIT_BURST)
+duplicates = DuplicateGuard(DUPLICATE_WINDOW)
+
+def is_repeatable(data):
+    return data.startswith(REPEATABLE_CALLBACKS) or (GALLERY_MODE and data.startswith(GALLERY_REPEATABLE_CALLBACKS))
+
+def callback_key(query):
+    message = query.message
+    if message is None:
+        return (query.inline_message_id, query.data)
+    return (message.chat.id, message.message_id, message.edit_date or message.date, query.data)
+
+async def guard_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user is None:
+        return
+    query = update.callback_query
+    now = time.monotonic()
+    # Primero los repetidos: un doble toque no debe gastar fichas del límite
+    key = None
+    if query and query.data and not is_repeatable(query.data):
+        key = callback_key(query)
+        if duplicates.is_duplicate(key, now):
+            metrics.inc("updates_dropped_total", reason="duplicate")
+            await query.answer()
+            raise ApplicationHandlerStop
+    if RATE_LIMIT_BURST > 0 and not es_admin(user.id) and not rate_limiter.allow(user.id, now):
+        metrics.inc("updates_dropped_total", reason="rate")
+        if key is not None:
+            duplicates.forget(key)
+        if query and rate_limiter.first_denial(user.id):
+            await query.answer("⏳ Vas muy rápido. Espera un momento.")
+        raise ApplicationHandlerStop
+
+# --- INSTRUMENTACIÓN ---
+# build_application envuelve el callback de cada handler registrado (también
+# los de dentro de las conversaciones) para medir su duración, y el bot usa
+# un HTTPXRequest que cuenta las llamadas a la Bot API y sus errores.
+
+def instrument_callback(callback):
+    name = callback.__name__
+    
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            metrics.inc("handler_errors_total", handler=name)
+            raise
+        finally:
+            metrics.observe("handler_seconds", time.perf_counter() - start, handler=name)
+    return wrapper
+
+def instrument_handlers(application):
+    def walk(handlers):
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                walk(handler.entry_points)
+                for state_handlers in handler.states.values():
+                    walk(state_handlers)
+                walk(handler.fallbacks)
+            else:
+                handler.callback = instrument_callback(handler.callback)
+    for handlers in application.handlers.values():
+        walk(handlers)
+
+class InstrumentedRequest(HTTPXRequest):
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        metrics.inc("api_calls_total", method=method)
+        start = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except TelegramError as e:
+            metrics.inc("api_errors_total", method=method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("api_seconds", time.perf_counter() - start, method=method)
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    metrics.inc("update_errors_total", error=type(context.error).__name__)
+    logger.error("Error al procesar un update", exc_info=context.error)
+
+async def serve_webhook(application, port, url_path, webhook_url):
+    """Equivalente a run_webhook con un servidor propio que además publica METRICS_PATH"""
+    import tornado.web
+    from tornado.httpserver import HTTPServer
+
+    class WebhookHandler(tornado.web.RequestHandler):
+        async def post(self):
+            try:
+                update = Update.de_json(json.loads(self.request.body), application.bot)
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+            await application.update_queue.put(update)
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.write(metrics.prometheus())
+
+    server = HTTPServer(tornado.web.Application([(rf"/{url_path}/?", WebhookHandler), (METRICS_PATH, MetricsHandler)]))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # Mismo orden que run_webhook: post_init antes de recibir updates y post_shutdown al final
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    server.listen(port, address="0.0.0.0")
+    await application.bot.set_webhook(webhook_url)
+    await application.start()
+    try:
+        await stop.wait()
+    finally:
+        server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# --- PROCESAMIENTO CONCURRENTE ---
+# Con CONCURRENT_UPDATES > 1 se atienden hasta esa cantidad de updates a la
+# vez, pero los de un mismo chat siguen en orden: así un send_photo lento de un
+# cliente no frena a los demás y los pasos del checkout nunca se adelantan.
+
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 1))
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        # PTB toma su semáforo antes de llamar a do_process_update: con el límite real, los
+        # updates que esperan el turno de su chat ocuparían puestos y frenarían a otros chats.
+        # Por eso a PTB se le pasa un límite holgado y el real se aplica dentro del candado
+        super().__init__(max(max_concurrent_updates, 2) * 1024)
+        self.workers = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks = {}   # chat_id -> [lock, updates esperando o en curso]
+
+    async def do_process_update(self, update, coroutine):
+        chat = (update.effective_chat or update.effective_user) if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# --- SESIONES PERSISTENTES ---
+# user_data (zona, carrito, datos del checkout) y el paso de cada conversación
+# se guardan en SESSIONS_FILE, así un redespliegue no vacía los carritos. PTB
+# solo pasa los usuarios que tuvieron actividad y aquí además se omiten los que
+# no cambiaron; se escribe cada SESSIONS_INTERVAL segundos y al apagar.
+
+SESSIONS_FILE = os.environ.get("SESSIONS_FILE", f"{os.path.splitext(DATA_FILE)[0]}.sessions.db")
+SESSIONS_INTERVAL = float(os.environ.get("SESSIONS_INTERVAL", 10))
+
+SESSIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+class SqlitePersistence(BasePersistence):
+    def __init__(self, path, update_interval=SESSIONS_INTERVAL):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False), update_interval=update_interval)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SESSIONS_SCHEMA)
+        self._written = {}   # user_id -> último JSON guardado
+
+    async def get_user_data(self):
+        self._written = dict(self.db.execute("SELECT user_id, data FROM user_data"))
+        return {user_id: json.loads(text) for user_id, text in self._written.items()}
+
+    async def update_user_data(self, user_id, data):
+        text = json.dumps(data, ensure_ascii=False)
+        if self._written.get(user_id) == text:
+            return
+        with self.db:
+            self.db.execute("INSERT INTO user_data (user_id, data) VALUES (?, ?) ON CONFLICT (user_id) DO UPDATE SET data = excluded.data", (user_id, text))
+        self._written[user_id] = text
+
+    async def drop_user_data(self, user_id):
+        with self.db:
+            self.db.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+        self._written.pop(user_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_conversations(self, name):
+        rows = self.db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        with self.db:
+            if new_state is None:
+                self.db.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+            else:
+                self.db.execute("INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) ON CONFLICT (name, key) DO UPDATE SET state = excluded.state",
+                                (name, json.dumps(key), json.dumps(new_state)))
+
+    async def flush(self):
+        self.db.close()
+
+    # Solo se persisten user_data y conversaciones
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+def build_application(builder=None):
+    """Crea la aplicación con todos los handlers (bench.py la usa con un bot simulado)"""
+    if builder is None:
+        builder = Application.builder().token(TOKEN).request(InstrumentedRequest(connection_pool_size=256))
+    builder = builder.post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+    if SESSIONS_FILE:
+        builder = builder.persistence(SqlitePersistence(SESSIONS_FILE))
+    application = builder.build()
+
+    # Antes que cualquier otro handler: límite de ritmo y toques repetidos
+    application.add_handler(TypeHandler(Update, guard_update), group=-1)
 
     # --- CLIENTES ---
     # Zonas y Menú
     application.add_handler(CallbackQueryHandler(set_zone, pattern="^zone_"))
-    application.add_handler(CallbackQueryHandler(main_menu, pattern="^back_main$"))
+    application.add_handler(CallbackQueryHandler(back_main, pattern="^back_main$"))
     application.add_handler(CallbackQueryHandler(select_zone_start, pattern="^change_zone$"))
     application.add_handler(CallbackQueryHandler(view_menu, pattern="^view_menu$"))
     application.add_handler(CallbackQueryHandler(view_product, pattern="^prod_"))
+    application.add_handler(CallbackQueryHandler(view_gallery, pattern="^view_gallery$"))
     application.add_handler(CallbackQueryHandler(add_to_cart, pattern="^addcart_"))
     application.add_handler(CallbackQueryHandler(view_cart, pattern="^view_cart$"))
     application.add_handler(CallbackQueryHandler(clear_cart, pattern="^clear_cart$"))
-    application.add_handler(CallbackQueryHandler(my_orders, pattern="^my_orders$"))
+    application.add_handler(CallbackQueryHandler(update_cart_item, pattern="^c[+-]"))
+    application.add_handler(CallbackQueryHandler(my_orders, pattern="^(my_orders|myord_[on]_\\d+)$"))
+    application.add_handler(CallbackQueryHandler(my_archived_orders, pattern="^myarch(_\\d{4}-\\d{2})?$"))
     
     # Checkout
     checkout_conv = ConversationHandler(
@@ -565,6 +3245,7 @@ def main():
             CHK_PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, checkout_phone)],
         },
         fallbacks=[CommandHandler("cancel", confirm_order_reject)], 
+        name="checkout", persistent=True,
     )
     application.add_handler(checkout_conv)
     application.add_handler(CallbackQueryHandler(confirm_order_accept, pattern="^confirm_order_accept$"))
@@ -572,9 +3253,18 @@ def main():
 
     # --- ADMINISTRADOR ---
     application.add_handler(CallbackQueryHandler(admin_clear_menu, pattern="^admin_clear$"))
-    application.add_handler(CallbackQueryHandler(admin_orders_mgmt, pattern="^admin_orders$"))
+    application.add_handler(CallbackQueryHandler(admin_orders_mgmt, pattern="^(admin_orders|admq_[np]_\\d+)$"))
     application.add_handler(CallbackQueryHandler(admin_balance, pattern="^admin_balance$"))
+    application.add_handler(CallbackQueryHandler(admin_balance_view, pattern="^bal_(1|7|month|zone)$"))
     application.add_handler(CallbackQueryHandler(admin_action_order, pattern="^adm_(accept|reject|done)_"))
+    application.add_handler(CallbackQueryHandler(admin_import_help, pattern="^admin_import$"))
+    application.add_handler(CallbackQueryHandler(admin_export_menu, pattern="^admin_export$"))
+    application.add_handler(CommandHandler("importar", admin_import_help))
+    application.add_handler(CommandHandler("exportar", admin_export_menu))
+    application.add_handler(CommandHandler("stats", admin_stats))
+    application.add_handler(CommandHandler("reporte", admin_report))
+    application.add_handler(CommandHandler("stock", admin_stock))
+    application.add_handler(MessageHandler(filters.Document.ALL, admin_import_menu))
     
     # Agregar Producto
     add_conv = ConversationHandler(
@@ -585,6 +3275,7 @@ def main():
             ADD_PHOTO: [MessageHandler(filters.PHOTO, admin_add_photo), CallbackQueryHandler(admin_skip_photo, pattern="^skip_photo_add$")]
         },
         fallbacks=[CommandHandler("cancel", admin_skip_photo)],
+        name="add_product", persistent=True,
     )
     application.add_handler(add_conv)
 
@@ -592,18 +3283,34 @@ def main():
     # Esto permite que los botones con callback_data="start" funcionen
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CallbackQueryHandler(start, pattern="^start$"))
+    
+    instrument_handlers(application)
+    application.add_error_handler(error_handler)
+    return application
+
+def main():
+    application = build_application()
 
     # --- WEBHOOK ---
     port = int(os.environ.get("PORT", 8443))
-    webhook_url = os.environ.get("RENDER_EXTERNAL_URL")
+    url = webhook_url()
     
-    if webhook_url:
-        webhook_url = f"{webhook_url}/telegram-webhook"
-        print(f"🚀 Iniciando WEBHOOK en: {webhook_url}")
-        application.run_webhook(listen="0.0.0.0", port=port, url_path="telegram-webhook", webhook_url=webhook_url)
+    if url:
+        logger.info("🚀 Iniciando WEBHOOK en: %s", url)
+        if METRICS_PATH:
+            asyncio.run(serve_webhook(application, port, WEBHOOK_PATH, url))
+        else:
+            application.run_webhook(listen="0.0.0.0", port=port, url_path=WEBHOOK_PATH, webhook_url=url)
     else:
-        print("🖥️ Iniciando POLLING (Local)...")
+        logger.info("🖥️ Iniciando POLLING (Local)...")
         application.run_polling()
 
 if __name__ == "__main__":
-    main()
+    # Migración única: python bot.py migrate [database.json] [database.db]
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        source = sys.argv[2] if len(sys.argv) > 2 else "database.json"
+        target = sys.argv[3] if len(sys.argv) > 3 else "database.db"
+        menu_count, orders_count = migrate_json_to_sqlite(source, target)
+        print(f"✅ Migrados {menu_count} productos y {orders_count} pedidos de {source} a {target}")
+    else:
+        main()